@@ -0,0 +1,249 @@
+# 吞吐量压测：启动本地替身（standins.py suite），在 127.0.0.0/8 上用合成IP集合运行扫描流水线
+# 记录 IP/秒、各阶段结束时间、峰值内存和文件描述符，结果追加到 benchmark_results.jsonl 供回归对比
+# 用法: python benchmark.py [--sizes 1000,10000,100000] [--hello-error-rate 0.9] [--real-limits]
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+results_file = "benchmark_results.jsonl"
+fd_sample_interval = 0.1  # 文件描述符采样间隔（秒）
+first_ip = (127 << 24) + 1  # 合成IP从 127.0.0.1 开始
+
+# 当前打开的文件描述符数（Linux 读 /proc，macOS 读 /dev/fd）
+def open_fds():
+    for path in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return None
+
+# 进程已使用的CPU时间（用户态+内核态，秒）
+def cpu_seconds(who):
+    if resource is None:
+        return None
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+# 进程生命周期内的峰值常驻内存（MB），ru_maxrss 在 macOS 上是字节，Linux 上是 KB
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+# 子进程入口：每个规模在新进程中运行，峰值内存和描述符互不影响
+def run_size(size, settings, verbose, result_queue):
+    sys.path.insert(0, here)
+    import isdnsok
+    for name, value in settings.items():
+        setattr(isdnsok, name, value)
+    if not verbose:
+        logging.disable(logging.ERROR)
+    result_queue.put(asyncio.run(measure(isdnsok, size, settings)))
+
+async def measure(isdnsok, size, settings):
+    ip_ranges = isdnsok.IpRangeSet([(4, first_ip, first_ip + size - 1)])
+    peak_fds = open_fds() or 0
+
+    async def sample_fds():
+        nonlocal peak_fds
+        while True:
+            peak_fds = max(peak_fds, open_fds() or 0)
+            await asyncio.sleep(fd_sample_interval)
+
+    sampler = asyncio.create_task(sample_fds())
+    cpu_start = cpu_seconds(resource.RUSAGE_SELF) if resource else None
+    with tempfile.TemporaryDirectory() as directory:
+        journal = isdnsok.ScanJournal(os.path.join(directory, 'journal.jsonl'), isdnsok.input_key(ip_ranges))
+        pipeline = isdnsok.ScanPipeline(isdnsok.load_colo_mapping(), None, journal)
+        # 子进程重新导入 isdnsok，默认参数之外的配置要显式传过去
+        pipeline.worker_args = isdnsok.parse_args([])
+        pipeline.worker_settings = {name: value for name, value in settings.items() if name in isdnsok.shard_settings}
+        start = time.monotonic()
+        try:
+            await pipeline.run(ip_ranges)
+        finally:
+            journal.close()
+            sampler.cancel()
+        wall = time.monotonic() - start
+    # 子进程异常退出时结果不完整，不能作为对比基线
+    if pipeline.tested < size:
+        raise SystemExit(f"Only {pipeline.tested} of {size} IPs were tested, not recording this run")
+    # 替身和扫描共用本机CPU，每CPU秒的IP数比墙钟吞吐更能反映扫描本身的开销
+    cpu = cpu_seconds(resource.RUSAGE_SELF) - cpu_start if resource else None
+    if cpu is not None and isdnsok.worker_processes > 1:
+        cpu += cpu_seconds(resource.RUSAGE_CHILDREN)
+
+    result = {
+        'size': size,
+        'wall': round(wall, 3),
+        'ips_per_sec': round(size / wall, 1),
+        'cpu_seconds': round(cpu, 2) if cpu is not None else None,
+        'ips_per_cpu_sec': round(size / cpu, 1) if cpu else None,
+        'stages': pipeline.stage_times,
+        'working': len(pipeline.ip_info),
+        'completed': len(pipeline.results),
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        'peak_fds': peak_fds if open_fds() is not None else None,
+    }
+    if pipeline.controller is not None:
+        result['concurrency'] = pipeline.controller.summary()
+    if isdnsok.worker_processes > 1 and resource is not None:
+        result['peak_rss_children_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+# 启动替身服务，等待其输出监听信息
+def start_standins(args, cert_dir):
+    command = [
+        sys.executable, os.path.join(here, 'standins.py'), 'suite',
+        '--hello-port', str(args.hello_port), '--geo-port', str(args.geo_port), '--proxy-port', str(args.proxy_port),
+        '--cert-dir', cert_dir, '--seed', str(args.seed),
+        '--window', str(60 if args.real_limits else args.geo_window),
+        '--hello-latency', str(args.hello_latency), '--hello-error-rate', str(args.hello_error_rate),
+        '--hello-timeout-rate', str(args.hello_timeout_rate),
+        '--proxy-latency', str(args.proxy_latency), '--proxy-jitter', str(args.proxy_jitter),
+        '--proxy-error-rate', str(args.proxy_error_rate), '--proxy-timeout-rate', str(args.proxy_timeout_rate),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if 'listening' not in line:
+        process.kill()
+        raise SystemExit("Stand-in services failed to start")
+    return process
+
+# 传给 isdnsok 的配置：指向本地替身；默认放开客户端限速，只测量本机吞吐
+def scan_settings(args):
+    settings = {
+        'port': args.hello_port,
+        'latency_port': args.hello_port,
+        'geo_api': f"http://127.0.0.1:{args.geo_port}/batch?fields=status,message,country,regionName,city,isp,org,as,query",
+        'check_proxy_url': f"http://127.0.0.1:{args.proxy_port}/check?proxyip={{ip}}",
+        'cache_file': None,
+        'concurrency_limit': args.concurrency,
+        'adaptive_concurrency': not args.fixed_concurrency,
+        'worker_processes': args.workers,
+        'probe_engine': args.engine,
+    }
+    if not args.real_limits:
+        settings.update({
+            'geo_rate_period': args.geo_window,
+            'proxy_rate_limit': 1000000,
+            'proxy_rate_period': 1,
+        })
+    return settings
+
+# 配置的摘要，只与相同配置的历史结果对比
+def settings_key(args):
+    fields = {name: value for name, value in vars(args).items() if name not in ('sizes', 'label', 'verbose', 'output')}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:12]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# 与同配置、同规模的上一次结果对比，返回百分比变化
+def compare(result, history):
+    previous = [entry for entry in history
+                if entry['size'] == result['size'] and entry['settings'] == result['settings']]
+    if not previous:
+        return ""
+    last = previous[-1]
+    changes = []
+    for field in ('ips_per_sec', 'ips_per_cpu_sec', 'peak_rss_mb', 'peak_fds'):
+        if last.get(field) and result.get(field) is not None:
+            changes.append(f"{field} {(result[field] - last[field]) / last[field] * 100:+.1f}%")
+    return f"vs {last.get('commit') or last['time']}: " + ", ".join(changes)
+
+# 等待子进程的结果，子进程异常退出时停止
+def wait_result(process, result_queue):
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            process.join()
+            return result
+        except queue.Empty:
+            if not process.is_alive():
+                raise SystemExit(f"Benchmark process exited with code {process.exitcode}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="isdnsok.py 吞吐量压测")
+    parser.add_argument('--sizes', default='1000,10000,100000', help='合成IP集合的规模，逗号分隔')
+    parser.add_argument('--output', default=results_file, help='结果文件（JSON Lines，追加写入）')
+    parser.add_argument('--label', help='本次结果的备注')
+    parser.add_argument('--concurrency', type=int, default=1000, help='HTTP测试并发上限')
+    parser.add_argument('--fixed-concurrency', action='store_true', help='关闭自适应并发')
+    parser.add_argument('--engine', choices=['aiohttp', 'raw'], default='aiohttp', help='HTTP测试引擎')
+    parser.add_argument('--workers', type=int, default=1, help='HTTP和延迟测试的进程数')
+    parser.add_argument('--real-limits', action='store_true', help='保留地理位置和代理检查的真实限速（很慢）')
+    parser.add_argument('--geo-window', type=int, default=1, help='地理位置替身的限速窗口（秒），真实接口为60')
+    parser.add_argument('--hello-port', type=int, default=8443)
+    parser.add_argument('--geo-port', type=int, default=8081)
+    parser.add_argument('--proxy-port', type=int, default=8082)
+    parser.add_argument('--hello-latency', type=float, default=0, help='hello 响应延迟（毫秒）')
+    parser.add_argument('--hello-error-rate', type=float, default=0.9, help='不可用IP的比例')
+    parser.add_argument('--hello-timeout-rate', type=float, default=0, help='超时IP的比例')
+    parser.add_argument('--proxy-latency', type=float, default=100, help='代理检查平均延迟（毫秒）')
+    parser.add_argument('--proxy-jitter', type=float, default=30, help='代理检查延迟标准差（毫秒）')
+    parser.add_argument('--proxy-error-rate', type=float, default=0.02, help='代理检查返回错误的比例')
+    parser.add_argument('--proxy-timeout-rate', type=float, default=0.01, help='代理检查超时的比例')
+    parser.add_argument('--seed', type=int, default=1, help='替身随机种子')
+    parser.add_argument('--verbose', action='store_true', help='输出扫描日志')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    history = load_history(args.output)
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as cert_dir:
+        standins = start_standins(args, cert_dir)
+        try:
+            for size in sizes:
+                result_queue = context.Queue()
+                process = context.Process(target=run_size, args=(size, scan_settings(args), args.verbose, result_queue))
+                process.start()
+                result = wait_result(process, result_queue)
+                result.update({
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'commit': git_commit(),
+                    'label': args.label,
+                    'settings': settings_key(args),
+                })
+                stages = ", ".join(f"{stage} {t:.2f}s" for stage, t in result['stages'].items())
+                print(f"{size:>7} IPs | {result['ips_per_sec']:>9.1f} IP/s | {result['ips_per_cpu_sec']} IP/CPU-s | "
+                      f"wall {result['wall']:.2f}s | "
+                      f"{stages} | RSS {result['peak_rss_mb']} MB | FDs {result['peak_fds']} | "
+                      f"working {result['working']}", flush=True)
+                change = compare(result, history)
+                if change:
+                    print(f"        {change}", flush=True)
+                with open(args.output, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        finally:
+            standins.terminate()
+            standins.wait()
+
+if __name__ == "__main__":
+    main()
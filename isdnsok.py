@@ -1,6 +1,6 @@
 import aiohttp
+from aiohttp import web
 import asyncio
-import socket
 import csv
 import time
 import json
@@ -8,8 +8,30 @@ import os
 import ipaddress
 import platform
 import logging
+import ssl
+import contextvars
+import contextlib
+import functools
+import argparse
+import hashlib
 from datetime import datetime
-import ping3
+import socket
+import struct
+import itertools
+import heapq
+import bisect
+import array
+import collections
+import queue
+import multiprocessing
+import concurrent.futures
+import statistics
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+import random
+import sqlite3
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,21 +39,129 @@ logger = logging.getLogger(__name__)
 
 # 配置
 domain = "hello.domain.xyz" #可以自行搭建hello world的worker设置域名开启小黄云
-url = f"https://{domain}/"
+url_path = "/"
+port = 443  # HTTPS端口
 check_proxy_url = "https://check.proxyip.cmliussss.net/check?proxyip={ip}" #最好自己搭建，确保公共资源不浪费
-geo_api = "http://ip-api.com/json/{ip}?lang=zh-CN&fields=status,message,country,regionName,city,isp,org,as,query"
+geo_api = "http://ip-api.com/batch?lang=zh-CN&fields=status,message,country,regionName,city,isp,org,as,query"  # 批量查询接口（POST）
 timeout = 5  # HTTP请求超时时间（秒）
 ping_timeout = 2  # Ping超时时间（秒）
 ping_count = 3    # 每个IP的Ping次数
-concurrency_limit = 1000  # HTTP测试并发限制,数值越小，越精准
-geo_concurrency = 20    # 地理位置查询并发限制
+latency_concurrency = 200  # 延迟测试并发限制
+latency_port = 443         # 无ICMP权限时回退到TCP连接测试的端口
+concurrency_limit = 1000  # HTTP测试并发限制,数值越小，越精准（自适应模式下为上限）
+per_host_limit = 2      # 共享连接池中每个目标IP的最大连接数
+probe_keepalive = 2     # 探测连接空闲保持时间（秒），过大会占用大量文件描述符
+probe_samples = 1       # 每个可用IP的HTTP请求次数，>1 时额外的请求只用于统计连接各阶段耗时
+probe_engine = "aiohttp"  # HTTP测试引擎：aiohttp，或 raw（直接用 asyncio 流，每个IP的开销更小）
+probe_connect_timeout = 3  # raw 引擎：TCP连接和TLS握手的超时（秒）
+probe_read_timeout = 5     # raw 引擎：发送请求后读取响应的超时（秒）
+probe_marker = "Hello World!"  # 可用IP的响应中应包含的内容
+probe_read_limit = 1024  # 最多读取的响应字节数，读到标记即停止并关闭连接
+colo_trace_fallback = True  # 响应没有 CF-RAY 头时请求 /cdn-cgi/trace 获取机房
+proxy_check = True      # 代理检查阶段（机房已由HTTP测试获得，只在需要代理可用性时开启）
+find_count = 0          # 找到这么多延迟不超过 find_max_delay 的可用IP后提前结束，0 为测试全部
+find_max_delay = None   # 提前结束的延迟门槛（ms），None 表示任意可用IP都计入
+sort_key = "ping_delay" # 结果排序字段：ping_delay / connect_p50 / tls_p50 / ttfb_p50 / total_p50
+geo_concurrency = 1     # 地理位置批量查询的并发请求数（为1时等待额度期间到达的IP会合并成一批）
 proxy_concurrency = 20  # 代理检查并发限制
+stage_queue_size = 10000  # 流水线各阶段队列长度，队列满时上游等待
+
+# HTTP测试自适应并发（AIMD）：网络健康时逐步加并发，超时率上升、延迟膨胀或事件循环卡顿时成倍回退
+adaptive_concurrency = True
+initial_concurrency = 100      # 起始并发
+min_concurrency = 20           # 最低并发
+concurrency_step = 50          # 每个周期增加的并发数
+concurrency_backoff = 0.7      # 拥塞时并发乘以该系数
+control_interval = 1.0         # 调整周期（秒）
+timeout_rate_margin = 0.05     # 超时率比基线高出该值视为拥塞
+latency_inflation = 2.0        # 请求耗时中位数超过基线的倍数视为拥塞
+max_loop_lag = 0.1             # 事件循环延迟超过该值（秒）视为CPU饱和
+fd_reserve = 256               # 为日志、缓存等保留的文件描述符数
+
+# 扫描模式：full 逐个测试所有地址；adaptive 先在每个 /24（IPv6 为 /48）抽样，
+# 再按成功率和延迟排序，只展开有希望的子网，适合大网段
+scan_mode = "full"
+max_range_size = 1 << 24       # full 模式下单个网段的地址数上限（IPv4 /8），更大的网段跳过，adaptive 模式不受限
+adaptive_samples = 4           # 每个子网的抽样数
+adaptive_min_success = 0.25    # 抽样成功率达到该值的子网才会展开
+adaptive_dense_samples = 256   # IPv6 子网无法全部测试，展开时追加的抽样数
+adaptive_budget = 1000000      # 探测总次数上限（多进程时各分片按地址数分摊）
+
+#geo-ip批量接口限制为每次100个IP、15次/分钟，实际额度以响应头 X-Rl/X-Ttl 为准
+geo_batch_size = 100    # 每次批量查询的IP数量
+geo_rate_limit = 15     # 每个周期允许的批量请求数
+geo_rate_period = 60    # 限速周期（秒）
+geo_timeout = 10        # 批量查询超时时间（秒）
+geo_max_retries = 3     # 被限速（429）时的重试次数
+
+# 离线地理位置：不请求 ip-api.com，从本地IP段数据库查询
+geo_backend = "online"         # online 使用在线接口；offline 使用 geo_db_file
+geo_db_file = "ip_ranges.csv"  # CSV（start,end,country,region,city,isp,asn）或 .mmdb（需要安装 maxminddb）
+
+# 代理检查限速：每 proxy_rate_period 秒最多 proxy_rate_limit 个请求
+proxy_rate_limit = 9
+proxy_rate_period = 11
+
+# 下载测速：排序后对前N个IP从同一域名下载，记录持续速率和下载首个1MB的耗时
+speed_test_top = 0             # 测速的IP数量，0 为关闭
+speed_test_path = "/__down?bytes=26214400"  # 下载路径（需要 worker 提供大文件）
+speed_test_bytes = 25 * 1024 * 1024  # 每个IP最多下载的字节数
+speed_test_duration = 10       # 每个IP最长下载时间（秒）
+speed_test_concurrency = 1     # 同时测速的IP数，带宽共享，建议保持较小
+speed_test_chunk = 64 * 1024   # 每次读取的块大小，数据读完即丢弃
+
+# 多进程分片：HTTP测试和延迟测试分到多个进程，各自运行事件循环；地理位置和代理检查在主进程
+worker_processes = 1           # 进程数，1 为单进程
+# 嵌入使用时（如压测）可在子进程中覆盖的配置，只包括子进程的HTTP测试和延迟测试用到的部分
+shard_settings = ('domain', 'port', 'latency_port', 'timeout', 'ping_timeout', 'ping_count',
+                  'concurrency_limit', 'adaptive_concurrency', 'probe_engine', 'probe_marker')
+use_uvloop = False             # 子进程使用 uvloop（需要安装）
+
+# 分布式扫描：协调者把IP集合切成工作单元，通过HTTP/JSON租给各节点上的 worker
+coordinator_unit_size = 4096   # 每个工作单元的地址数
+coordinator_unit_subnets = 16  # adaptive 模式下每个工作单元的子网数（/24 或 /48），由 worker 在单元内抽样展开
+coordinator_max_units = 1 << 20  # 工作单元数上限，输入过大时拒绝启动
+coordinator_lease = 120        # 租约时间（秒），期间没有心跳或结果的单元重新分配
+coordinator_max_attempts = 3   # 单元最多分配次数，超过后放弃
+
+# 常驻模式：持续复测，可用IP频繁复测，不可用IP按指数退避，通过HTTP接口提供当前最优IP
+daemon_good_interval = 300     # 可用IP的复测间隔（秒）
+daemon_retry_base = 600        # 不可用IP首次复测间隔（秒），之后每次连续失败翻倍
+daemon_retry_max = 86400       # 不可用IP复测间隔上限（秒）
+daemon_round_size = 5000       # 每轮最多测试的IP数
+daemon_watch_interval = 5      # 检查IP列表文件变化的间隔（秒）
+daemon_top_k = 10              # /best 默认返回的IP数
+daemon_max_ips = 1 << 20       # 记分板为每个IP保存状态，IP列表超过该数量时拒绝加载
+daemon_evict_interval = 3600   # 清理过期缓存并执行容量上限的间隔（秒）
+
+# 断点续扫日志：每个阶段结果完成后立即追加，--resume 时跳过已完成的部分
+journal_file = "scan_journal.jsonl"
+
+# 本地结果缓存（SQLite），重复扫描时跳过受限速的查询
+cache_file = "scan_cache.db"   # 设为 None 关闭缓存
+cache_ttl = {
+    'geo': 7 * 86400,      # 地理位置/ISP
+    'colo': 7 * 86400,     # 机房
+    'proxy': 6 * 3600,     # 代理可用性、端口、响应时间
+}
+cache_geo_prefix = True        # 同一 /24（IPv4）或 /48（IPv6）内复用地理位置
+cache_max_entries = 500000     # 超过后按最近访问时间淘汰（LRU）
+cache_touch_batch = 1000       # 命中的访问时间攒够这么多条后批量写入
+
+# 历史结果库（SQLite）：每次运行的结果都写入，按较长时间窗口的可用率和延迟百分位排名
+history_file = "scan_history.db"   # 设为 None 关闭
+history_window = "7d"              # 查询的默认时间窗口
 
-#geo-ip的查询限制为45次/分钟，以下最优设置尽量不要修改
-batch_size = 9         # 每批查询的IP数量（遵守API限制）
-batch_delay = 11        # 批次之间的延迟（秒）
+# 运行指标：各阶段结果计数、耗时直方图、进行中的请求数、事件循环延迟
+metrics_port = None            # 设置后在该端口提供 Prometheus 格式的 /metrics
+metrics_host = "127.0.0.1"
+metrics_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # 耗时直方图的桶（秒）
+metrics_interval = 0.05        # 事件循环延迟和队列长度的采样间隔（秒）
 
-max_cidr_size = 256     # 最大允许的CIDR范围大小（/24）
+# 日志模式：full 每个IP都输出日志；sampled 每秒最多输出 log_rate 条IP日志，并定期输出进度汇总
+log_mode = "full"
+log_rate = 20
+log_interval = 10              # sampled 模式下输出进度的间隔（秒）
 
 # 完全禁用 aiohttp DNS 日志（解决 macOS 警告问题）
 aiohttp_logger = logging.getLogger("aiohttp.resolver")
@@ -39,7 +169,39 @@ aiohttp_logger.setLevel(logging.CRITICAL)
 aiohttp_logger = logging.getLogger("aiohttp.client")
 aiohttp_logger.setLevel(logging.CRITICAL)
 
-# 加载机房代码到中文名称的映射
+# 按IP输出的日志：sampled 模式下每秒最多通过 log_rate 条，其余只计数
+class SampledLogFilter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.window_start = 0.0
+        self.used = 0
+
+    def filter(self, record):
+        if log_mode != 'sampled':
+            return True
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start = now
+            self.used = 0
+        if self.used < log_rate:
+            self.used += 1
+            return True
+        metrics.inc('log_lines_total', 'log', 'suppressed')
+        return False
+
+ip_logger = logging.getLogger(f"{__name__}.ip")
+ip_logger.addFilter(SampledLogFilter())
+
+# 机房代码的候选键：原样大写、去掉空格/括号后的部分、括号内的部分
+@functools.lru_cache(maxsize=4096)
+def colo_keys(colo_code):
+    code = colo_code.strip().upper()
+    keys = [code, code.split(" ")[0].split("(")[0]]
+    if "(" in code and ")" in code:
+        keys.append(code.split("(")[1].split(")")[0])
+    return tuple(dict.fromkeys(key for key in keys if key))
+
+# 加载机房代码到中文名称的映射，键预先规范化，查询时只做字典查找
 def load_colo_mapping():
     mapping_file = "colo_to_chinese.json"
     colo_mapping = {}
@@ -47,7 +209,9 @@ def load_colo_mapping():
     if os.path.exists(mapping_file):
         try:
             with open(mapping_file, 'r', encoding='utf-8') as f:
-                colo_mapping = json.load(f)
+                for code, name in json.load(f).items():
+                    for key in colo_keys(code):
+                        colo_mapping.setdefault(key, name)
             logger.info(f"成功加载 {len(colo_mapping)} 个机房代码映射")
         except Exception as e:
             logger.error(f"⚠️ 加载机房映射文件失败: {str(e)}")
@@ -61,164 +225,934 @@ def get_colo_chinese(colo_code, colo_mapping):
     if not colo_code or colo_code == "N/A":
         return "未知"
     
-    # 尝试直接匹配
-    if colo_code in colo_mapping:
-        return colo_mapping[colo_code]
+    # 机房代码通常是三字母代码，直接命中
+    name = colo_mapping.get(colo_code)
+    if name is not None:
+        return name
     
-    # 尝试去掉括号内容后匹配
-    clean_code = colo_code.split(" ")[0].split("(")[0]
-    if clean_code in colo_mapping:
-        return colo_mapping[clean_code]
-    
-    # 尝试匹配括号内的内容
-    if "(" in colo_code and ")" in colo_code:
-        bracket_code = colo_code.split("(")[1].split(")")[0]
-        if bracket_code in colo_mapping:
-            return colo_mapping[bracket_code]
+    # 依次尝试大写、去掉括号内容、括号内的内容
+    for key in colo_keys(colo_code):
+        if key in colo_mapping:
+            return colo_mapping[key]
     
     return colo_code  # 未找到映射，返回原始代码
 
-# 解析IP输入（支持单个IP、CIDR范围、IPv6）
+# 解析IP输入（支持单个IP、CIDR范围、IPv6），返回整数区间 (版本, 起始, 结束)
+# 与 network.hosts() 一致：IPv4 去掉网络地址和广播地址，IPv6 去掉子网路由器地址
 def parse_ip_input(input_line):
     try:
-        # 尝试解析为CIDR
         network = ipaddress.ip_network(input_line.strip(), strict=False)
-        
-        # 检查CIDR范围大小
-        if network.num_addresses > max_cidr_size:
-            logger.warning(f"⚠️ 跳过大范围CIDR: {input_line} (包含 {network.num_addresses} 个地址)")
-            return []
-            
-        # 返回CIDR中的所有地址
-        return [str(ip) for ip in network.hosts()]
     except ValueError:
+        # 无法解析为有效IP地址或网段
+        logger.warning(f"⚠️ 无效IP地址格式: {input_line.strip()}")
+        return None
+
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+    if network.version == 4 and network.prefixlen < 31:
+        first, last = first + 1, last - 1
+    elif network.version == 6 and network.prefixlen < 127:
+        first += 1
+    # 逐个测试大网段永远跑不完（一个IPv6 /32 有 2^96 个地址）
+    if scan_mode != 'adaptive' and last - first + 1 > max_range_size:
+        logger.warning(f"⚠️ 跳过大范围网段: {input_line.strip()} (包含 {last - first + 1} 个地址)，"
+                       f"请使用 --mode adaptive 抽样扫描")
+        return None
+    return network.version, first, last
+
+# 合并重叠或相邻的区间，结果按 (版本, 起始) 排序
+def merge_intervals(intervals):
+    merged = []
+    for version, first, last in sorted(intervals):
+        if merged and merged[-1][0] == version and first <= merged[-1][2] + 1:
+            if last > merged[-1][2]:
+                merged[-1] = (version, merged[-1][1], last)
+        else:
+            merged.append((version, first, last))
+    return merged
+
+# 整数形式的IP转回字符串
+def int_to_ip(version, value):
+    if version == 4:
+        return socket.inet_ntoa(value.to_bytes(4, 'big'))
+    return str(ipaddress.IPv6Address(value))
+
+# 去重合并后的IP集合，按需逐个生成地址，内存占用与网段大小无关
+class IpRangeSet:
+    def __init__(self, intervals):
+        self.intervals = merge_intervals(intervals)
+
+    @property
+    def count(self):
+        return sum(last - first + 1 for _, first, last in self.intervals)
+
+    def __iter__(self):
+        for version, first, last in self.intervals:
+            for value in range(first, last + 1):
+                yield int_to_ip(version, value)
+
+    def __bool__(self):
+        return bool(self.intervals)
+
+    # 按地址数切分成最多 n 份连续的子集，切分点尽量对齐到 /24（IPv6 为 /48）
+    def split(self, n):
+        remaining = self.count
+        shards = [[]]
+        size = 0
+        target = -(-remaining // n)
+        for version, first, last in self.intervals:
+            host_bits = 8 if version == 4 else 80
+            while first <= last:
+                room = target - size
+                # 最后一份收下剩余的全部地址
+                if last - first + 1 <= room or len(shards) == n:
+                    shards[-1].append((version, first, last))
+                    size += last - first + 1
+                    break
+                cut = first + room - 1
+                aligned = (((cut + 1) >> host_bits) << host_bits) - 1
+                if aligned >= first:
+                    cut = aligned
+                shards[-1].append((version, first, cut))
+                remaining -= size + cut - first + 1
+                # 对齐后每份大小不同，按剩余地址重新计算目标
+                target = max(1, -(-remaining // (n - len(shards))))
+                shards.append([])
+                size = 0
+                first = cut + 1
+        return [IpRangeSet(shard) for shard in shards if shard]
+
+# 读取IP列表文件（支持CIDR和IPv6），忽略空行和 # 注释
+def load_ip_ranges(path):
+    intervals = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                interval = parse_ip_input(line)
+                if interval is not None:
+                    intervals.append(interval)
+    return IpRangeSet(intervals)
+
+# IP所在的网段：IPv4取 /24，IPv6取 /48
+def ip_prefix(ip):
+    prefix = 48 if ":" in ip else 24
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+# 当前请求的耗时记录，TLS握手在协议回调中进行，通过上下文变量找到所属请求
+probe_timing = contextvars.ContextVar('probe_timing', default=None)
+
+# 记录TLS握手开始和结束时间的 SSLObject
+class TimedSSLObject(ssl.SSLObject):
+    def do_handshake(self):
+        timing = probe_timing.get()
+        if timing is not None:
+            timing.setdefault('tls_start', time.monotonic())
+        super().do_handshake()
+        if timing is not None:
+            timing['tls_end'] = time.monotonic()
+
+# 共享的SSL上下文（不校验证书，与原先 ssl=False 行为一致）
+def create_ssl_context():
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    ctx.sslobject_class = TimedSSLObject
+    return ctx
+
+# 把目标IP固定到URL中，域名通过 Host 头和 SNI 传递
+def pinned_url(ip, path="/"):
+    host = f"[{ip}]" if ":" in ip else ip
+    if port != 443:
+        host = f"{host}:{port}"
+    return f"https://{host}{path}"
+
+# 通过 aiohttp TraceConfig 记录连接建立、请求发出和收到响应头的时间
+def create_trace_config():
+    async def mark(name, trace_config_ctx):
+        timing = trace_config_ctx.trace_request_ctx
+        if timing is not None:
+            timing[name] = time.monotonic()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(lambda s, ctx, p: mark('request_start', ctx))
+    trace_config.on_connection_create_start.append(lambda s, ctx, p: mark('connect_start', ctx))
+    trace_config.on_connection_create_end.append(lambda s, ctx, p: mark('connect_end', ctx))
+    trace_config.on_request_headers_sent.append(lambda s, ctx, p: mark('headers_sent', ctx))
+    trace_config.on_request_end.append(lambda s, ctx, p: mark('response_start', ctx))
+    return trace_config
+
+# 把一次请求的时间点换算成各阶段耗时（ms）：TCP连接、TLS握手、首字节、总耗时
+def phase_durations(timing):
+    phases = {}
+    if 'connect_start' in timing:
+        connected = timing.get('tls_start', timing.get('connect_end'))
+        if connected is not None:
+            phases['connect'] = (connected - timing['connect_start']) * 1000
+        if 'tls_start' in timing and 'tls_end' in timing:
+            phases['tls'] = (timing['tls_end'] - timing['tls_start']) * 1000
+    if 'headers_sent' in timing and 'response_start' in timing:
+        phases['ttfb'] = (timing['response_start'] - timing['headers_sent']) * 1000
+    if 'request_start' in timing and 'response_start' in timing:
+        phases['total'] = (timing['response_start'] - timing['request_start']) * 1000
+    return phases
+
+timing_phases = ('connect', 'tls', 'ttfb', 'total')
+
+# 线性插值百分位数
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+# 多次请求的各阶段耗时汇总为 p50/p90
+def timing_percentiles(samples):
+    summary = {}
+    for phase in timing_phases:
+        values = [sample[phase] for sample in samples if phase in sample]
+        summary[f'{phase}_p50'] = round(percentile(values, 50), 2) if values else float('inf')
+        summary[f'{phase}_p90'] = round(percentile(values, 90), 2) if values else float('inf')
+    return summary
+
+# 运行指标：计数器、耗时直方图和仪表，按 (名称, 阶段) 归类
+# 多进程模式下子进程定期发送快照，主进程合并后输出
+class Metrics:
+    def __init__(self):
+        self.counters = collections.Counter()  # (名称, 阶段, 结果) -> 次数
+        self.histograms = {}                   # (名称, 阶段) -> [各桶计数..., 总和, 次数]
+        self.gauges = {}                       # (名称, 阶段) -> 当前值
+        self.remote = {}                       # 子进程编号 -> 快照
+
+    def inc(self, name, stage, outcome, n=1):
+        self.counters[(name, stage, outcome)] += n
+
+    def observe(self, name, stage, seconds):
+        histogram = self.histograms.get((name, stage))
+        if histogram is None:
+            histogram = self.histograms[(name, stage)] = [0] * (len(metrics_buckets) + 3)
+        index = next((i for i, bound in enumerate(metrics_buckets) if seconds <= bound), len(metrics_buckets))
+        histogram[index] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def set_gauge(self, name, stage, value):
+        self.gauges[(name, stage)] = value
+
+    def add_gauge(self, name, stage, delta):
+        self.gauges[(name, stage)] = self.gauges.get((name, stage), 0) + delta
+
+    # 统计一次请求：进行中计数、耗时和结果，调用方可修改 outcome['result']
+    @contextlib.contextmanager
+    def track(self, stage):
+        outcome = {'result': 'ok'}
+        self.add_gauge('in_flight', stage, 1)
+        start = time.monotonic()
         try:
-            # 尝试解析为单个IP地址（支持IPv4和IPv6）
-            ip = ipaddress.ip_address(input_line.strip())
-            return [str(ip)]
-        except ValueError:
-            # 无法解析为有效IP地址
-            logger.warning(f"⚠️ 无效IP地址格式: {input_line}")
-            return []
-
-# macOS 平台使用简化的解析器
-class SimpleResolver(aiohttp.resolver.AbstractResolver):
-    def __init__(self, ip):
-        self.ip = ip
-        self.is_ipv6 = ":" in ip
-        
-    async def resolve(self, host, port=0, family=socket.AF_INET):
-        if host == domain:
-            # 根据IP类型设置正确的family
-            family = socket.AF_INET6 if self.is_ipv6 else socket.AF_INET
-            return [{
-                'hostname': host,
-                'host': self.ip,
-                'port': port,
-                'family': family,
-                'proto': 0,
-                'flags': 0
-            }]
-        # 其他域名使用系统解析
-        return await aiohttp.resolver.DefaultResolver().resolve(host, port, family)
-    
-    async def close(self):
+            yield outcome
+        except asyncio.CancelledError:
+            outcome['result'] = 'cancelled'
+            raise
+        except BaseException:
+            outcome['result'] = 'error'
+            raise
+        finally:
+            self.add_gauge('in_flight', stage, -1)
+            self.observe('stage_duration_seconds', stage, time.monotonic() - start)
+            self.inc('stage_results_total', stage, outcome['result'])
+
+    # 事件循环延迟和各阶段队列长度，随流水线运行
+    async def watch(self, stage_queues):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(metrics_interval)
+            self.observe('loop_lag_seconds', 'loop', max(0.0, loop.time() - start - metrics_interval))
+            for stage, stage_queue in stage_queues.items():
+                self.set_gauge('queue_depth', stage, stage_queue.qsize())
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'histograms': {key: list(value) for key, value in self.histograms.items()},
+            'gauges': dict(self.gauges),
+        }
+
+    def merge(self, source, snapshot):
+        self.remote[source] = snapshot
+
+    # 本进程与各子进程快照之和
+    def combined(self):
+        counters = collections.Counter(self.counters)
+        histograms = {key: list(value) for key, value in self.histograms.items()}
+        gauges = collections.Counter(self.gauges)
+        for snapshot in self.remote.values():
+            counters.update(snapshot['counters'])
+            gauges.update(snapshot['gauges'])
+            for key, value in snapshot['histograms'].items():
+                if key in histograms:
+                    histograms[key] = [a + b for a, b in zip(histograms[key], value)]
+                else:
+                    histograms[key] = list(value)
+        return counters, histograms, gauges
+
+    # Prometheus 文本格式
+    def render(self):
+        counters, histograms, gauges = self.combined()
+        lines = []
+        for name in sorted({key[0] for key in counters}):
+            lines.append(f"# TYPE isdnsok_{name} counter")
+            for (metric, stage, outcome), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'isdnsok_{name}{{stage="{stage}",outcome="{outcome}"}} {value}')
+        for name in sorted({key[0] for key in histograms}):
+            lines.append(f"# TYPE isdnsok_{name} histogram")
+            for (metric, stage), value in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metrics_buckets) + ['+Inf'], value):
+                    cumulative += count
+                    lines.append(f'isdnsok_{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'isdnsok_{name}_sum{{stage="{stage}"}} {value[-2]:.6f}')
+                lines.append(f'isdnsok_{name}_count{{stage="{stage}"}} {value[-1]}')
+        for name in sorted({key[0] for key in gauges}):
+            lines.append(f"# TYPE isdnsok_{name} gauge")
+            for (metric, stage), value in sorted(gauges.items()):
+                if metric == name:
+                    lines.append(f'isdnsok_{name}{{stage="{stage}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    # 直方图的近似百分位（取所在桶的上界，秒）
+    @staticmethod
+    def bucket_percentile(histogram, p):
+        total = histogram[-1]
+        if not total:
+            return None
+        target = total * p / 100
+        cumulative = 0
+        for bound, count in zip(metrics_buckets, histogram):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    # 一行进度汇总：各阶段完成数、进行中数量、耗时p50、事件循环延迟p99
+    def progress(self):
+        counters, histograms, gauges = self.combined()
+        parts = []
+        for stage in ('http', 'geo', 'proxy', 'latency'):
+            outcomes = {outcome: value for (name, s, outcome), value in counters.items()
+                        if name == 'stage_results_total' and s == stage}
+            if not outcomes:
+                continue
+            detail = " ".join(f"{outcome} {value}" for outcome, value in sorted(outcomes.items()))
+            p50 = self.bucket_percentile(histograms.get(('stage_duration_seconds', stage), [0]), 50)
+            parts.append(f"{stage}: {detail}, in flight {gauges.get(('in_flight', stage), 0)}"
+                         + (f", p50 <= {p50 * 1000:.0f}ms" if p50 not in (None, float('inf')) else ""))
+        lag = self.bucket_percentile(histograms.get(('loop_lag_seconds', 'loop'), [0]), 99)
+        if lag is not None:
+            parts.append(f"loop lag p99 <= {lag * 1000:.0f}ms")
+        suppressed = counters.get(('log_lines_total', 'log', 'suppressed'))
+        if suppressed:
+            parts.append(f"{suppressed} log lines suppressed")
+        return " | ".join(parts)
+
+metrics = Metrics()
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+# 启动 /metrics 接口，返回 AppRunner（用于关闭）
+async def start_metrics_server(host, port):
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
+
+# 创建共享的探测会话：一个连接器、一个SSL上下文、一个解析器
+# 目标IP直接写在URL里，连接池按IP区分连接，不会把A的连接复用给B
+# 每次请求都新建连接（Connection: close），各阶段耗时才有意义
+def create_probe_session():
+    connector = aiohttp.TCPConnector(
+        limit=concurrency_limit,
+        limit_per_host=per_host_limit,
+        keepalive_timeout=probe_keepalive,
+        ssl=create_ssl_context(),
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={'Host': domain, 'Connection': 'close'},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        trace_configs=[create_trace_config()],
+    )
+
+# 单次请求，返回 (状态码, 响应开头部分, 各阶段耗时)
+# 只读取到标记出现或 probe_read_limit 字节，剩余部分不再下载
+async def fetch_probe(session, ip):
+    if isinstance(session, RawProbeSession):
+        return await session.fetch(ip, url_path, probe_marker.encode())
+    timing = {}
+    probe_timing.set(timing)
+    marker = probe_marker.encode()
+    async with session.get(
+        pinned_url(ip, url_path),
+        server_hostname=domain,
+        trace_request_ctx=timing,
+    ) as response:
+        body = b''
+        while marker not in body and len(body) < probe_read_limit:
+            chunk = await response.content.read(probe_read_limit - len(body))
+            if not chunk:
+                break
+            body += chunk
+        if not response.content.at_eof():
+            response.close()
+        text = body.decode(response.charset or 'utf-8', errors='replace')
+        return response.status, text, phase_durations(timing), colo_from_ray(response.headers.get('CF-RAY'))
+
+# CF-RAY 头形如 8abc1234def56789-LAX，后缀即为机房代码
+def colo_from_ray(ray):
+    if ray and '-' in ray:
+        return ray.rsplit('-', 1)[1].strip().upper() or None
+    return None
+
+# 从 /cdn-cgi/trace 的 colo= 行读取机房
+async def fetch_trace_colo(session, ip):
+    try:
+        if isinstance(session, RawProbeSession):
+            text = (await session.fetch(ip, "/cdn-cgi/trace"))[1]
+        else:
+            async with session.get(pinned_url(ip, "/cdn-cgi/trace"), server_hostname=domain) as response:
+                text = await response.text()
+        for line in text.splitlines():
+            if line.startswith('colo='):
+                return line[5:].strip().upper() or None
+    except Exception as e:
+        ip_logger.warning(f"⚠️ Trace error: {ip} | {str(e)}")
+    return None
+
+# 轻量探测引擎：直接用 asyncio 流发送预先构造的 HTTP/1.1 请求，只解析状态行、响应头和正文开头
+# 连接（含TLS握手）和读取分别限时，超时抛出 asyncio.TimeoutError，返回值与 fetch_probe 相同
+class RawProbeSession:
+    def __init__(self):
+        self.ssl_context = create_ssl_context()
+        self.requests = {}  # 路径 -> 请求字节串
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
         pass
 
-# Windows/Linux 平台使用自定义解析器
-class CustomResolver(aiohttp.resolver.AbstractResolver):
-    def __init__(self, ip):
-        self.ip = ip
-        self._system_resolver = aiohttp.resolver.AsyncResolver()
-        self.is_ipv6 = ":" in ip
-        
-    async def resolve(self, host, port=0, family=socket.AF_INET):
-        if host == domain:
-            # 根据IP类型设置正确的family
-            family = socket.AF_INET6 if self.is_ipv6 else socket.AF_INET
-            return [{
-                'hostname': host,
-                'host': self.ip,
-                'port': port,
-                'family': family,
-                'proto': 0,
-                'flags': 0
-            }]
-        return await self._system_resolver.resolve(host, port, family)
-    
-    async def close(self):
-        await self._system_resolver.close()
+    def request(self, path):
+        request = self.requests.get(path)
+        if request is None:
+            request = self.requests[path] = (
+                f"GET {path} HTTP/1.1\r\n"
+                f"Host: {domain}\r\n"
+                f"User-Agent: isdnsok\r\n"
+                f"Accept: */*\r\n"
+                f"Connection: close\r\n\r\n"
+            ).encode()
+        return request
+
+    # marker 不为空时读到 marker 即停止，否则读到 probe_read_limit 字节或连接关闭
+    async def fetch(self, ip, path, marker=None):
+        timing = {}
+        probe_timing.set(timing)
+        timing['request_start'] = timing['connect_start'] = time.monotonic()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port, ssl=self.ssl_context, server_hostname=domain),
+            probe_connect_timeout,
+        )
+        timing['connect_end'] = time.monotonic()
+        try:
+            writer.write(self.request(path))
+            timing['headers_sent'] = time.monotonic()
+            head, body = await asyncio.wait_for(self.read(reader, timing, marker), probe_read_timeout)
+        finally:
+            writer.close()
+        status, headers = parse_response_head(head)
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = dechunk(body)
+        text = body.decode('utf-8', errors='replace')
+        return status, text, phase_durations(timing), colo_from_ray(headers.get('cf-ray'))
 
-# 测试单个IP
+    @staticmethod
+    async def read(reader, timing, marker):
+        data = b''
+        end = -1
+        while True:
+            chunk = await reader.read(4096)
+            if not chunk:
+                break
+            data += chunk
+            if end < 0:
+                end = data.find(b'\r\n\r\n')
+                if end >= 0:
+                    timing['response_start'] = time.monotonic()
+            if end >= 0:
+                body = data[end + 4:]
+                if (marker is not None and marker in body) or len(body) >= probe_read_limit:
+                    break
+        if end < 0:
+            raise ConnectionError("connection closed before response headers")
+        return data[:end], data[end + 4:end + 4 + probe_read_limit]
+
+# 解析状态行和响应头，头名称转为小写
+def parse_response_head(head):
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ConnectionError(f"invalid status line: {lines[0][:50]}")
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(parts[1]), headers
+
+# 解码已读到的 chunked 正文（可能不完整）
+def dechunk(body):
+    result = b''
+    while body:
+        size_line, separator, rest = body.partition(b'\r\n')
+        if not separator:
+            break
+        try:
+            size = int(size_line.split(b';')[0], 16)
+        except ValueError:
+            break
+        if size == 0:
+            break
+        result += rest[:size]
+        body = rest[size + 2:]
+    return result
+
+# 测试单个IP（session 由 create_probe_session 创建，所有IP共用）
+# 返回 (ip, 是否可用, 状态码, 响应片段, 请求耗时ms, 各阶段耗时百分位, 机房)
 async def test_ip(session, ip, semaphore):
     async with semaphore:
-        try:
-            # 根据平台选择解析器
-            if platform.system() == 'Darwin':
-                resolver = SimpleResolver(ip)
-            else:
-                resolver = CustomResolver(ip)
-            
-            connector = aiohttp.TCPConnector(resolver=resolver, ssl=False)
+        with metrics.track('http') as outcome:
+            start = time.monotonic()
+            try:
+                status, text, phases, colo = await fetch_probe(session, ip)
+                elapsed = round((time.monotonic() - start) * 1000, 2)
             
-            async with aiohttp.ClientSession(connector=connector) as local_session:
-                async with local_session.get(
-                    url, 
-                    timeout=aiohttp.ClientTimeout(total=timeout),
-                    ssl=False
-                ) as response:
-                    text = await response.text()
-                    status = response.status
-                    
-                    if status == 200 and "Hello World!" in text:
-                        logger.info(f"✅ Success: {ip} | Status: {status} | Response: '{text[:12]}'")
-                        return ip, True, status, text[:12]
-                    else:
-                        logger.warning(f"❌ Fail: {ip} | Status: {status}")
-                        return ip, False, status, ""
+                if status == 200 and probe_marker in text:
+                    # 额外采样只统计耗时，失败的采样不影响可用性判断
+                    samples = [phases]
+                    for _ in range(probe_samples - 1):
+                        try:
+                            samples.append((await fetch_probe(session, ip))[2])
+                        except Exception:
+                            pass
+                    if colo is None and colo_trace_fallback:
+                        colo = await fetch_trace_colo(session, ip)
+                    ip_logger.info(f"✅ Success: {ip} | Status: {status} | Colo: {colo} | Response: '{text[:12]}'")
+                    return ip, True, status, text[:12], elapsed, timing_percentiles(samples), colo
+                else:
+                    outcome['result'] = 'fail'
+                    ip_logger.warning(f"❌ Fail: {ip} | Status: {status}")
+                    return ip, False, status, "", elapsed, {}, None
                         
-        except Exception as e:
-            logger.error(f"⚠️ Error: {ip} | {str(e)}")
-            return ip, False, 0, ""
+            except Exception as e:
+                ip_logger.error(f"⚠️ Error: {ip} | {str(e)}")
+                # 超时的耗时记为 inf，其他错误（如连接被拒绝）记录实际耗时
+                if isinstance(e, asyncio.TimeoutError):
+                    outcome['result'] = 'timeout'
+                    return ip, False, 0, "", float('inf'), {}, None
+                outcome['result'] = 'error'
+                return ip, False, 0, "", round((time.monotonic() - start) * 1000, 2), {}, None
+
+# 当前进程可用的文件描述符数，尽量把软限制提到硬限制
+def fd_limit():
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return None if soft == resource.RLIM_INFINITY else soft
+
+# 自适应并发控制器（AIMD），用法与 asyncio.Semaphore 相同
+# 每个周期根据超时率、请求耗时膨胀和事件循环延迟调整并发上限
+class ConcurrencyController:
+    def __init__(self, initial, minimum, maximum):
+        fds = fd_limit()
+        if fds is not None and fds - fd_reserve < maximum:
+            maximum = max(minimum, fds - fd_reserve)
+            logger.info(f"Concurrency capped at {maximum} by file descriptor limit {fds}")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.waiters = collections.deque()
+        self.samples = []
+        self.max_lag = 0.0
+        self.base_latency = None
+        self.base_timeout_rate = None
+        self.history = [(0.0, self.limit)]
+        metrics.set_gauge('concurrency_limit', 'http', self.limit)
+        self.loop = asyncio.get_running_loop()
+        self.started_at = self.loop.time()
+
+    async def __aenter__(self):
+        while self.in_flight >= self.limit:
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                # 已被唤醒但还没占用名额就被取消，把名额交给下一个等待者
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def __aexit__(self, *exc):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = self.limit - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    # 记录一次请求耗时（ms），超时为 inf
+    def observe(self, elapsed):
+        self.samples.append(elapsed)
+
+    async def _watch_loop_lag(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(0.05)
+            self.max_lag = max(self.max_lag, self.loop.time() - start - 0.05)
+
+    def _adjust(self):
+        samples, self.samples = self.samples, []
+        lag, self.max_lag = self.max_lag, 0.0
+        if len(samples) < 20 and lag <= max_loop_lag:
+            return
+
+        finished = [x for x in samples if x != float('inf')]
+        timeout_rate = 1 - len(finished) / len(samples) if samples else 0.0
+        latency = statistics.median(finished) if finished else None
+
+        # 基线取观察到的最好值，并缓慢放宽，避免一次偶然的低值导致长期误判
+        if latency is not None:
+            self.base_latency = latency if self.base_latency is None else min(latency, self.base_latency * 1.05)
+        if samples:
+            self.base_timeout_rate = timeout_rate if self.base_timeout_rate is None else min(timeout_rate, self.base_timeout_rate + 0.01)
+
+        reasons = []
+        if samples and timeout_rate > self.base_timeout_rate + timeout_rate_margin:
+            reasons.append(f"timeouts {timeout_rate:.0%}")
+        if latency is not None and latency > self.base_latency * latency_inflation:
+            reasons.append(f"latency x{latency / self.base_latency:.1f}")
+        if lag > max_loop_lag:
+            reasons.append(f"loop lag {lag * 1000:.0f}ms")
+
+        old = self.limit
+        if reasons:
+            self.limit = max(self.minimum, int(self.limit * concurrency_backoff))
+        elif self.peak_in_flight >= self.limit * 0.8:
+            # 只有并发确实用满时才继续增加
+            self.limit = min(self.maximum, self.limit + concurrency_step)
+        self.peak_in_flight = self.in_flight
+
+        if self.limit != old:
+            metrics.set_gauge('concurrency_limit', 'http', self.limit)
+            self.history.append((self.loop.time() - self.started_at, self.limit))
+            logger.info(f"Concurrency limit {old} -> {self.limit}"
+                        + (f" ({', '.join(reasons)})" if reasons else "")
+                        + (f", median {latency:.0f}ms" if latency is not None else ""))
+            self._wake()
+
+    async def run(self):
+        watcher = asyncio.create_task(self._watch_loop_lag())
+        try:
+            while True:
+                await asyncio.sleep(control_interval)
+                self._adjust()
         finally:
-            await resolver.close()
+            watcher.cancel()
 
-# 查询IP地理位置
-async def query_geo(session, ip, semaphore):
-    async with semaphore:
+    def summary(self):
+        limits = [limit for _, limit in self.history]
+        return f"final {self.limit}, min {min(limits)}, max {max(limits)}, {len(limits) - 1} adjustments"
+
+# 令牌桶限速器，可根据服务端返回的剩余额度和重置时间校正
+class TokenBucket:
+    def __init__(self, rate, period):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated_at = time.monotonic()
+        self.reset_at = None  # 已知服务端窗口的重置时间
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.reset_at is not None:
+            # 服务端已告知剩余额度：窗口重置前不再补充令牌
+            if now >= self.reset_at:
+                self.tokens = float(self.capacity)
+                self.reset_at = None
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.fill_rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                if self.reset_at is not None:
+                    wait = self.reset_at - self.updated_at
+                else:
+                    wait = (1 - self.tokens) / self.fill_rate
+                await asyncio.sleep(max(wait, 0.01))
+
+    # 根据响应头校正：remaining 为当前窗口剩余请求数，reset_in 为窗口剩余秒数
+    # 服务端返回的秒数是取整后的，多等1秒避免窗口未重置就发请求
+    def update(self, remaining, reset_in):
+        self._refill()
+        self.tokens = float(min(self.capacity, remaining))
+        self.reset_at = self.updated_at + reset_in + 1
+
+    def update_from_headers(self, headers):
         try:
-            url = geo_api.format(ip=ip)
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
-                data = await response.json()
+            remaining = int(headers['X-Rl'])
+            reset_in = int(headers['X-Ttl'])
+        except (KeyError, ValueError):
+            return
+        self.update(remaining, reset_in)
+
+# 单个IP的地理位置结果
+def geo_record(ip, data):
+    if data.get('status') == 'success':
+        return {
+            'ip': ip,
+            'country': data.get('country', 'N/A'),
+            'region': data.get('regionName', 'N/A'),
+            'city': data.get('city', 'N/A'),
+            'isp': data.get('isp', 'N/A'),
+            'asn': data.get('as', '').split(' ')[0] or 'N/A',
+        }
+    return {
+        'ip': ip,
+        'country': '查询失败',
+        'region': data.get('message', 'Unknown error'),
+        'city': 'N/A',
+        'isp': 'N/A',
+    }
+
+def geo_error(ip, message):
+    return {
+        'ip': ip,
+        'country': '查询异常',
+        'region': message[:50],
+        'city': 'N/A',
+        'isp': 'N/A',
+    }
+
+# 离线地理位置库：IP段按起始地址排序存入整数数组，二分查找
+# IPv4 用 array（每个地址8字节），IPv6 超出64位，用整数列表
+# 记录去重后按编号引用，同一国家/城市/ISP的大量网段只存一份
+class OfflineGeo:
+    def __init__(self, path):
+        self.reader = None
+        self.starts = {4: array.array('Q'), 6: []}
+        self.ends = {4: array.array('Q'), 6: []}
+        self.indexes = {4: array.array('L'), 6: array.array('L')}
+        self.records = []
+        if path.endswith('.mmdb'):
+            self._open_mmdb(path)
+        else:
+            self._load_csv(path)
+
+    def _open_mmdb(self, path):
+        try:
+            import maxminddb
+        except ImportError:
+            raise SystemExit("Reading .mmdb files requires the maxminddb package (pip install maxminddb)")
+        self.reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+        logger.info(f"Opened offline geo database {path}")
+
+    # 每行: 起始IP, 结束IP, 国家, 地区, 城市, ISP[, ASN]；起止也可以是整数；首行可为表头
+    def _load_csv(self, path):
+        ranges = {4: [], 6: []}
+        seen = {}
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            for fields in csv.reader(f):
+                if len(fields) < 6 or fields[0].startswith('#'):
+                    continue
+                try:
+                    start, end = self._address(fields[0]), self._address(fields[1])
+                except (ValueError, OSError):
+                    continue  # 表头或无效行
+                if start[0] != end[0]:
+                    continue
+                record = tuple(field.strip() or 'N/A' for field in fields[2:7])
+                record += ('N/A',) * (5 - len(record))
+                index = seen.get(record)
+                if index is None:
+                    index = seen[record] = len(self.records)
+                    self.records.append(record)
+                ranges[start[0]].append((start[1], end[1], index))
+        for version, items in ranges.items():
+            items.sort()
+            for start, end, index in items:
+                self.starts[version].append(start)
+                self.ends[version].append(end)
+                self.indexes[version].append(index)
+        logger.info(f"Loaded offline geo database {path}: {len(ranges[4])} IPv4 and {len(ranges[6])} IPv6 ranges, "
+                    f"{len(self.records)} distinct records")
+
+    # 返回 (版本, 整数地址)；inet_pton 比 ipaddress 快一个数量级
+    @staticmethod
+    def _address(text):
+        text = text.strip()
+        if text.isdigit():
+            value = int(text)
+            return (4 if value < 2 ** 32 else 6), value
+        if ':' in text:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, text), 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, text), 'big')
+
+    def lookup(self, ip):
+        if self.reader is not None:
+            return self._lookup_mmdb(ip)
+        version, value = self._address(ip.strip('[]'))
+        position = bisect.bisect_right(self.starts[version], value) - 1
+        if position < 0 or value > self.ends[version][position]:
+            return geo_record(ip, {'status': 'fail', 'message': 'not in offline database'})
+        country, region, city, isp, asn = self.records[self.indexes[version][position]]
+        return {'ip': ip, 'country': country, 'region': region, 'city': city, 'isp': isp, 'asn': asn}
+
+    # GeoLite2 City/ASN 格式，名称优先取中文
+    def _lookup_mmdb(self, ip):
+        data = self.reader.get(ip)
+        if not data:
+            return geo_record(ip, {'status': 'fail', 'message': 'not in offline database'})
+
+        def name(item):
+            names = (item or {}).get('names', {})
+            return names.get('zh-CN') or names.get('en') or 'N/A'
+
+        subdivisions = data.get('subdivisions') or [{}]
+        asn = data.get('autonomous_system_number')
+        return {
+            'ip': ip,
+            'country': name(data.get('country')),
+            'region': name(subdivisions[0]),
+            'city': name(data.get('city')),
+            'isp': data.get('autonomous_system_organization', 'N/A'),
+            'asn': f"AS{asn}" if asn else 'N/A',
+        }
+
+# 离线库只加载一次（常驻模式每轮都会新建流水线）
+@functools.lru_cache(maxsize=1)
+def load_offline_geo(path):
+    return OfflineGeo(path)
+
+# 扫描开始前加载离线库，路径错误或文件无效时立即退出，而不是等HTTP测试结束后才报错
+def preload_offline_geo():
+    try:
+        offline = load_offline_geo(geo_db_file)
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"Cannot load offline geo database {geo_db_file}: {e}")
+    if offline.reader is None and not offline.records:
+        raise SystemExit(f"Offline geo database {geo_db_file} contains no IP ranges")
+
+# 批量查询IP地理位置（一次最多 geo_batch_size 个），limiter 为共享的令牌桶
+# 先查缓存，只有未命中的IP才会请求接口并消耗额度
+async def query_geo(session, ips, limiter, cache=None):
+    results = {}
+    if cache is not None:
+        for ip in ips:
+            cached = cache.get_geo(ip)
+            if cached is not None:
+                results[ip] = cached
+        if results:
+            metrics.inc('stage_results_total', 'geo', 'cached', len(results))
+    missing = [ip for ip in ips if ip not in results]
+    if missing:
+        with metrics.track('geo') as outcome:
+            fetched = await fetch_geo(session, missing, limiter)
+            if all(geo['country'] in ('查询失败', '查询异常') for geo in fetched):
+                outcome['result'] = 'error'
+        if cache is not None:
+            cache.put_geo([geo for geo in fetched if geo['country'] not in ('查询失败', '查询异常')])
+        results.update((geo['ip'], geo) for geo in fetched)
+    return [results[ip] for ip in ips]
+
+async def fetch_geo(session, ips, limiter):
+    for attempt in range(geo_max_retries + 1):
+        await limiter.acquire()
+        try:
+            async with session.post(
+                geo_api,
+                json=ips,
+                timeout=aiohttp.ClientTimeout(total=geo_timeout)
+            ) as response:
+                limiter.update_from_headers(response.headers)
+                if response.status == 429:
+                    if attempt < geo_max_retries:
+                        logger.warning(f"⚠️ Geo API rate limited, retrying batch of {len(ips)} IPs "
+                                       f"({attempt + 1}/{geo_max_retries})")
+                    continue
+                data = await response.json(content_type=None)
                 
-                if data['status'] == 'success':
-                    return {
-                        'ip': ip,
-                        'country': data.get('country', 'N/A'),
-                        'region': data.get('regionName', 'N/A'),
-                        'city': data.get('city', 'N/A'),
-                        'isp': data.get('isp', 'N/A'),
-                    }
-                else:
-                    return {
-                        'ip': ip,
-                        'country': '查询失败',
-                        'region': data.get('message', 'Unknown error'),
-                        'city': 'N/A',
-                        'isp': 'N/A',
-                    }
+            # 批量接口按请求顺序返回结果，数量不符时无法对应，整批按失败处理
+            if not isinstance(data, list) or len(data) != len(ips):
+                count = len(data) if isinstance(data, list) else type(data).__name__
+                logger.warning(f"⚠️ Geo API returned {count} results for a batch of {len(ips)} IPs")
+                return [geo_error(ip, 'malformed batch response') for ip in ips]
+            return [geo_record(ip, item) for ip, item in zip(ips, data)]
                     
         except Exception as e:
-            return {
-                'ip': ip,
-                'country': '查询异常',
-                'region': str(e)[:50],
-                'city': 'N/A',
-                'isp': 'N/A',
-            }
+            return [geo_error(ip, str(e)) for ip in ips]
+
+    return [geo_error(ip, 'rate limited') for ip in ips]
+
+# 检查代理信息，先查缓存；limiter 为共享的令牌桶
+async def check_proxy(session, ip, semaphore, limiter=None, cache=None):
+    if cache is not None:
+        cached = cache.get_proxy(ip)
+        if cached is not None:
+            metrics.inc('stage_results_total', 'proxy', 'cached')
+            return cached
+    if limiter is not None:
+        await limiter.acquire()
+    with metrics.track('proxy') as outcome:
+        result = await fetch_proxy_info(session, ip, semaphore)
+        if result['colo'] == 'N/A':
+            outcome['result'] = 'error'
+    # 只缓存成功解析的响应
+    if cache is not None and result['colo'] != 'N/A':
+        cache.put_proxy(result)
+    return result
 
-# 检查代理信息 - 增强错误处理
-async def check_proxy(session, ip, semaphore):
+# 请求代理检查接口 - 增强错误处理
+async def fetch_proxy_info(session, ip, semaphore):
     async with semaphore:
         try:
             # 格式化IPv6地址（如果适用）
@@ -243,7 +1177,7 @@ async def check_proxy(session, ip, semaphore):
                         except json.JSONDecodeError:
                             # 不是有效的JSON，记录响应片段
                             snippet = text[:100] + ('...' if len(text) > 100 else '')
-                            logger.warning(f"⚠️ Proxy check: {ip} returned non-JSON response: {snippet}")
+                            ip_logger.warning(f"⚠️ Proxy check: {ip} returned non-JSON response: {snippet}")
                             return {
                                 'ip': ip,
                                 'proxy_available': False,
@@ -254,7 +1188,7 @@ async def check_proxy(session, ip, semaphore):
                     else:
                         # 不是JSON，记录响应片段
                         snippet = text[:100] + ('...' if len(text) > 100 else '')
-                        logger.warning(f"⚠️ Proxy check: {ip} returned non-JSON response: {snippet}")
+                        ip_logger.warning(f"⚠️ Proxy check: {ip} returned non-JSON response: {snippet}")
                         return {
                             'ip': ip,
                             'proxy_available': False,
@@ -274,7 +1208,7 @@ async def check_proxy(session, ip, semaphore):
                 
         except aiohttp.ClientError as e:
             # 网络请求错误
-            logger.error(f"⚠️ Proxy check error: {ip} | Network error: {str(e)}")
+            ip_logger.error(f"⚠️ Proxy check error: {ip} | Network error: {str(e)}")
             return {
                 'ip': ip,
                 'proxy_available': False,
@@ -284,7 +1218,7 @@ async def check_proxy(session, ip, semaphore):
             }
         except json.JSONDecodeError as e:
             # JSON解析错误
-            logger.error(f"⚠️ Proxy check error: {ip} | JSON decode error: {str(e)}")
+            ip_logger.error(f"⚠️ Proxy check error: {ip} | JSON decode error: {str(e)}")
             return {
                 'ip': ip,
                 'proxy_available': False,
@@ -294,7 +1228,7 @@ async def check_proxy(session, ip, semaphore):
             }
         except Exception as e:
             # 其他未知错误
-            logger.error(f"⚠️ Proxy check error: {ip} | Unexpected error: {str(e)}")
+            ip_logger.error(f"⚠️ Proxy check error: {ip} | Unexpected error: {str(e)}")
             return {
                 'ip': ip,
                 'proxy_available': False,
@@ -303,151 +1237,842 @@ async def check_proxy(session, ip, semaphore):
                 'response_time': -1
             }
 
-# Ping测试延迟（支持IPv6）
-def ping_ip(ip):
-    try:
-        delays = []
-        for _ in range(ping_count):
-            # 对于IPv6地址，确保使用正确的格式
-            target = ip
-            if ":" in ip:
-                # 移除IPv6地址的方括号（如果有）
-                target = ip.strip("[]")
-            
-            # macOS 平台优化：增加超时时间
-            current_timeout = ping_timeout * 2 if platform.system() == 'Darwin' else ping_timeout
-            
-            delay = ping3.ping(target, timeout=current_timeout, unit='ms')
-            if delay is not None:
-                delays.append(delay)
-        
-        if delays:
-            avg_delay = sum(delays) / len(delays)
-            return round(avg_delay, 2)
+# 本地结果缓存：SQLite存储，按类型设置过期时间，超过容量按最近访问时间淘汰
+class ResultCache:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache (accessed_at)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_cache_stored ON cache (kind, stored_at)")
+        self.db.commit()
+        self.hits = {kind: 0 for kind in cache_ttl}
+        self.misses = {kind: 0 for kind in cache_ttl}
+        self.touched = {}  # (kind, key) -> 最近访问时间，攒够一批再写入
+
+    # 命中时只记下访问时间：逐条 UPDATE 会开启事务并一直占着写锁，其他进程无法写入缓存
+    def get(self, kind, key):
+        now = time.time()
+        row = self.db.execute(
+            "SELECT value FROM cache WHERE kind = ? AND key = ? AND stored_at > ?",
+            (kind, key, now - cache_ttl[kind])
+        ).fetchone()
+        if row is None:
+            return None
+        self.touched[(kind, key)] = now
+        if len(self.touched) >= cache_touch_batch:
+            self.flush()
+        return json.loads(row[0])
+
+    # 写入攒下的访问时间并提交
+    def flush(self):
+        if self.touched:
+            self.db.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE kind = ? AND key = ?",
+                [(accessed_at, kind, key) for (kind, key), accessed_at in self.touched.items()]
+            )
+            self.touched.clear()
+        self.db.commit()
+
+    def put_many(self, kind, items):
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO cache (kind, key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            [(kind, key, json.dumps(value, ensure_ascii=False), now, now) for key, value in items]
+        )
+        self.flush()
+
+    def _count(self, kind, value):
+        if value is None:
+            self.misses[kind] += 1
         else:
-            return float('inf')
-            
-    except Exception as e:
-        logger.error(f"⚠️ Ping error: {ip} | {str(e)}")
-        return float('inf')
+            self.hits[kind] += 1
+        return value
 
-# 主异步函数
-async def main():
-    # 加载机房映射
-    colo_mapping = load_colo_mapping()
-    
-    # 读取IP列表（支持CIDR和IPv6）
-    ip_list = []
-    with open('ip.txt', 'r') as f:
-        for line in f:
-            if line.strip():
-                parsed_ips = parse_ip_input(line)
-                if parsed_ips:
-                    ip_list.extend(parsed_ips)
-    
-    if not ip_list:
-        logger.error("No valid IP addresses found in ip.txt")
-        return
-    
-    logger.info(f"Testing {len(ip_list)} IP addresses (including CIDR expansions)...")
-    start_time = time.time()
-    
-    # 测试IP可用性
-    semaphore = asyncio.Semaphore(concurrency_limit)
-    tasks = []
-    async with aiohttp.ClientSession() as session:
-        for ip in ip_list:
-            task = asyncio.create_task(test_ip(session, ip, semaphore))
-            tasks.append(task)
-        
-        results = await asyncio.gather(*tasks)
-    
-    # 收集成功的IP和状态信息
-    working_ips = []
-    ip_info = {}
-    
-    for result in results:
-        ip, success, status, response_text = result
+    # 地理位置：先按IP精确匹配，再按 /24 或 /48 网段匹配
+    def get_geo(self, ip):
+        geo = self.get('geo', ip)
+        if geo is None and cache_geo_prefix:
+            geo = self.get('geo', ip_prefix(ip))
+        if geo is not None:
+            geo = dict(geo, ip=ip)
+        return self._count('geo', geo)
+
+    def put_geo(self, geos):
+        items = [(geo['ip'], geo) for geo in geos]
+        if cache_geo_prefix:
+            items += [(ip_prefix(geo['ip']), geo) for geo in geos]
+        self.put_many('geo', items)
+
+    # 代理信息：可用性和机房分开过期，两者都有效才算命中
+    def get_proxy(self, ip):
+        proxy = self.get('proxy', ip)
+        if proxy is None:
+            return self._count('proxy', None)
+        colo = self._count('colo', self.get('colo', ip))
+        if colo is None:
+            return self._count('proxy', None)
+        return self._count('proxy', dict(proxy, colo=colo))
+
+    def put_proxy(self, result):
+        proxy = {k: v for k, v in result.items() if k != 'colo'}
+        self.put_many('proxy', [(result['ip'], proxy)])
+        self.put_many('colo', [(result['ip'], result['colo'])])
+
+    # 按最近访问时间淘汰超出容量的条目，同时清理过期条目
+    def evict(self):
+        self.flush()
+        now = time.time()
+        for kind, ttl in cache_ttl.items():
+            self.db.execute("DELETE FROM cache WHERE kind = ? AND stored_at <= ?", (kind, now - ttl))
+        (total,) = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if total > cache_max_entries:
+            self.db.execute(
+                "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY accessed_at LIMIT ?)",
+                (total - cache_max_entries,)
+            )
+        self.db.commit()
+
+    def summary(self):
+        return ", ".join(f"{kind} {self.hits[kind]} hits / {self.misses[kind]} misses" for kind in cache_ttl)
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+# 历史结果库：runs 记录每次运行，ips 为IP编号，probes 为每次运行中每个IP的结果
+# 只记录曾经可用过的IP，它们之后的失败也会记录，用于计算长期可用率
+class HistoryStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                started_at REAL NOT NULL,
+                finished_at REAL NOT NULL,
+                input TEXT,
+                tested INTEGER NOT NULL,
+                working INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ips (
+                id INTEGER PRIMARY KEY,
+                ip TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS probes (
+                run_id INTEGER NOT NULL,
+                ip_id INTEGER NOT NULL,
+                ts REAL NOT NULL,
+                working INTEGER NOT NULL,
+                colo TEXT,
+                ping_delay REAL,
+                row TEXT
+            );
+            -- 覆盖排名查询用到的列，按IP分组时不必回表
+            CREATE INDEX IF NOT EXISTS idx_probes_ip ON probes (ip_id, ts, working, ping_delay);
+            CREATE INDEX IF NOT EXISTS idx_probes_colo ON probes (colo, ts);
+            CREATE INDEX IF NOT EXISTS idx_probes_ts ON probes (ts);
+        """)
+        self.db.commit()
+        self.ip_ids = dict(self.db.execute("SELECT ip, id FROM ips"))
+
+    # 曾经可用过的IP，流水线据此记录它们的失败
+    @property
+    def known(self):
+        return self.ip_ids
+
+    def _ip_id(self, ip):
+        ip_id = self.ip_ids.get(ip)
+        if ip_id is None:
+            ip_id = self.db.execute("INSERT INTO ips (ip) VALUES (?)", (ip,)).lastrowid
+            self.ip_ids[ip] = ip_id
+        return ip_id
+
+    # 写入一次运行：rows 为合并后的可用IP结果，failed 为本次失败的已知IP
+    def record_run(self, started_at, input_key, tested, rows, failed):
+        now = time.time()
+        run_id = self.db.execute(
+            "INSERT INTO runs (started_at, finished_at, input, tested, working) VALUES (?, ?, ?, ?, ?)",
+            (started_at, now, input_key, tested, len(rows))
+        ).lastrowid
+        probes = [
+            (run_id, self._ip_id(row['ip']), started_at, 1, row['colo_code'],
+             None if row['ping_delay'] == float('inf') else row['ping_delay'],
+             json.dumps({key: row.get(key) for key in csv_fields}, ensure_ascii=False))
+            for row in rows
+        ]
+        probes += [(run_id, self.ip_ids[ip], started_at, 0, None, None, None) for ip in failed if ip in self.ip_ids]
+        self.db.executemany(
+            "INSERT INTO probes (run_id, ip_id, ts, working, colo, ping_delay, row) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            probes
+        )
+        self.db.commit()
+        return run_id
+
+    # 按时间窗口排名：可用率从高到低，再按可用时的延迟中位数从低到高
+    # colo 过滤先用 colo 索引找出候选IP，country 按最近一次结果过滤
+    def rank(self, since, colo=None, country=None, min_probes=1, limit=None):
+        query = """
+            SELECT ip_id, COUNT(*), SUM(working),
+                   GROUP_CONCAT(CASE WHEN working AND ping_delay IS NOT NULL THEN ping_delay END)
+            FROM probes WHERE ts >= ?
+        """
+        params = [since]
+        if colo:
+            query += " AND ip_id IN (SELECT ip_id FROM probes WHERE colo = ? AND ts >= ?)"
+            params += [colo.upper(), since]
+        query += " GROUP BY ip_id HAVING COUNT(*) >= ?"
+        params.append(min_probes)
+
+        stats = []
+        for ip_id, probes, successes, delays in self.db.execute(query, params):
+            if not successes:
+                continue
+            values = [float(x) for x in delays.split(',')] if delays else []
+            stats.append({
+                'ip_id': ip_id,
+                'probes': probes,
+                'availability': round(successes / probes, 3),
+                'ping_p50': round(percentile(values, 50), 2) if values else float('inf'),
+                'ping_p90': round(percentile(values, 90), 2) if values else float('inf'),
+            })
+        stats.sort(key=lambda x: (-x['availability'], x['ping_p50']))
+
+        rows = []
+        for stat in stats:
+            latest = self.db.execute(
+                "SELECT row FROM probes WHERE ip_id = ? AND working = 1 ORDER BY ts DESC LIMIT 1",
+                (stat.pop('ip_id'),)
+            ).fetchone()
+            row = dict(json.loads(latest[0]), **stat)
+            if colo and str(row.get('colo_code', '')).upper() != colo.upper():
+                continue
+            if country and row.get('country') != country:
+                continue
+            rows.append(row)
+            if limit and len(rows) >= limit:
+                break
+        return rows
+
+    def close(self):
+        self.db.close()
+
+# 时间窗口，如 30m、12h、7d
+def parse_duration(text):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+# 计算ICMP校验和
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+# 打开ICMP套接字：优先原始套接字（需要root），其次Linux的非特权ping套接字
+def open_icmp_socket(family):
+    proto = socket.IPPROTO_ICMP if family == socket.AF_INET else socket.IPPROTO_ICMPV6
+    for sock_type in (socket.SOCK_RAW, socket.SOCK_DGRAM):
+        try:
+            sock = socket.socket(family, sock_type, proto)
+        except (PermissionError, OSError):
+            continue
+        sock.setblocking(False)
+        return sock, sock_type == socket.SOCK_RAW
+    return None, False
+
+# 异步ICMP探测器：每个地址族共用一个套接字，按 (目标IP, 序号) 匹配回包
+class IcmpPinger:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.ident = os.getpid() & 0xFFFF
+        self.seq = itertools.count(1)
+        self.pending = {}
+        self.sockets = {}
+        for family in (socket.AF_INET, socket.AF_INET6):
+            sock, raw = open_icmp_socket(family)
+            if sock is not None:
+                self.sockets[family] = (sock, raw)
+                self.loop.add_reader(sock.fileno(), self._on_readable, family)
+
+    @property
+    def available(self):
+        return bool(self.sockets)
+
+    # 该地址族是否有可用的ICMP套接字，没有时由调用方回退到TCP连接测试
+    def supports(self, ip):
+        return (socket.AF_INET6 if ":" in ip else socket.AF_INET) in self.sockets
+
+    def _on_readable(self, family):
+        sock, raw = self.sockets[family]
+        while True:
+            try:
+                data, addr = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            # IPv4原始套接字收到的数据包含IP头
+            if family == socket.AF_INET and raw:
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, ident, seq = struct.unpack("!BBHHH", data[:8])
+            if icmp_type not in (0, 129):  # Echo Reply (v4 / v6)
+                continue
+            # 非特权ping套接字的标识由内核改写，只有原始套接字需要校验
+            if raw and ident != self.ident:
+                continue
+            future = self.pending.pop((addr[0], seq), None)
+            if future is not None and not future.done():
+                future.set_result(self.loop.time())
+
+    async def ping(self, ip, ping_timeout):
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        if family not in self.sockets:
+            return None
+        sock, raw = self.sockets[family]
+        seq = next(self.seq) & 0xFFFF
+        icmp_type = 8 if family == socket.AF_INET else 128
+        payload = struct.pack("!d", time.time())
+        header = struct.pack("!BBHHH", icmp_type, 0, 0, self.ident, seq)
+        checksum = icmp_checksum(header + payload)
+        packet = struct.pack("!BBHHH", icmp_type, 0, checksum, self.ident, seq) + payload
+
+        key = (ipaddress.ip_address(ip).compressed, seq)
+        future = self.loop.create_future()
+        self.pending[key] = future
+        try:
+            sent_at = self.loop.time()
+            sock.sendto(packet, (ip, 0))
+            received_at = await asyncio.wait_for(future, ping_timeout)
+            return (received_at - sent_at) * 1000
+        except (asyncio.TimeoutError, OSError):
+            return None
+        finally:
+            self.pending.pop(key, None)
+
+    def close(self):
+        for sock, _ in self.sockets.values():
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+        self.sockets.clear()
+
+# TCP连接测试延迟（无ICMP权限时使用）
+async def tcp_ping(ip, ping_timeout):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, latency_port), ping_timeout)
+    except (asyncio.TimeoutError, OSError):
+        return None
+    elapsed = (loop.time() - start) * 1000
+    writer.close()
+    return elapsed
+
+# 测试单个IP的延迟（支持IPv6），返回最小/平均/抖动/丢包率
+async def measure_latency(ip, semaphore, pinger=None):
+    # macOS 平台优化：增加超时时间
+    current_timeout = ping_timeout * 2 if platform.system() == 'Darwin' else ping_timeout
+    target = ip.strip("[]")
+
+    async with semaphore:
+        with metrics.track('latency') as outcome:
+            delays = []
+            try:
+                for _ in range(ping_count):
+                    if pinger is not None and pinger.supports(target):
+                        delay = await pinger.ping(target, current_timeout)
+                    else:
+                        delay = await tcp_ping(target, current_timeout)
+                    if delay is not None:
+                        delays.append(delay)
+            except Exception as e:
+                ip_logger.error(f"⚠️ Ping error: {ip} | {str(e)}")
+            if not delays:
+                outcome['result'] = 'lost'
+
+    loss = round((ping_count - len(delays)) / ping_count * 100, 1)
+    if not delays:
+        return {
+            'ip': ip,
+            'ping_min': float('inf'),
+            'ping_delay': float('inf'),
+            'ping_jitter': float('inf'),
+            'ping_loss': loss,
+        }
+
+    # 抖动取相邻两次延迟差值的平均值
+    jitter = statistics.mean(abs(a - b) for a, b in zip(delays, delays[1:])) if len(delays) > 1 else 0.0
+    return {
+        'ip': ip,
+        'ping_min': round(min(delays), 2),
+        'ping_delay': round(sum(delays) / len(delays), 2),
+        'ping_jitter': round(jitter, 2),
+        'ping_loss': loss,
+    }
+
+# 把区间切分成 /24（IPv4）或 /48（IPv6）子网，按需生成 (版本, 起始, 结束)
+def iter_subnets(intervals):
+    for version, first, last in intervals:
+        host_bits = 8 if version == 4 else 80
+        start = first
+        while start <= last:
+            end = min((((start >> host_bits) + 1) << host_bits) - 1, last)
+            yield version, start, end
+            start = end + 1
+
+# 在子网内均匀抽取 count 个地址
+def spread_samples(first, last, count):
+    size = last - first + 1
+    if size <= count:
+        return list(range(first, last + 1))
+    step = size / count
+    return [first + int(step * i + step / 2) for i in range(count)]
+
+# 在子网内随机抽取 count 个未测试过的地址（用于无法全部测试的IPv6子网）
+def random_samples(first, last, count, exclude):
+    size = last - first + 1
+    picked = set()
+    while len(picked) < min(count, size - len(exclude)):
+        value = random.randint(first, last)
+        if value not in exclude:
+            picked.add(value)
+    return sorted(picked)
+
+# 分层自适应扫描：先抽样，再按子网成功率和延迟排序，按预算展开
+async def adaptive_scan(pipeline, ip_ranges):
+    budget = adaptive_budget
+    subnets = []          # [版本, 起始, 结束, 已测试地址, 成功数, 成功延迟列表]
+    sample_owner = {}
+
+    # 第一轮：每个子网抽样
+    samples = []
+    for version, first, last in iter_subnets(ip_ranges.intervals):
+        if budget <= 0:
+            logger.warning("⚠️ Probe budget exhausted during sampling, remaining subnets skipped")
+            break
+        picked = spread_samples(first, last, min(adaptive_samples, budget))
+        budget -= len(picked)
+        subnet = [version, first, last, set(picked), 0, []]
+        subnets.append(subnet)
+        for value in picked:
+            ip = int_to_ip(version, value)
+            sample_owner[ip] = subnet
+            samples.append(ip)
+
+    def record(result):
+        ip, success, _, _, elapsed = result[:5]
+        subnet = sample_owner.pop(ip)
         if success:
-            working_ips.append(ip)
-        ip_info[ip] = {
+            subnet[4] += 1
+            subnet[5].append(elapsed)
+
+    logger.info(f"Adaptive scan: sampling {len(samples)} IPs in {len(subnets)} subnets...")
+    await pipeline.probe_many(samples, record)
+
+    # 排序：成功率高、延迟低的子网优先展开
+    promising = [s for s in subnets if s[4] / len(s[3]) >= adaptive_min_success]
+    promising.sort(key=lambda s: (-s[4] / len(s[3]), statistics.mean(s[5]) if s[5] else float('inf')))
+    logger.info(f"Adaptive scan: {len(promising)}/{len(subnets)} subnets promising, "
+                f"expanding with budget {budget}...")
+
+    # 第二轮：展开有希望的子网（IPv4 全部测试，IPv6 加密抽样）
+    def expansion():
+        nonlocal budget
+        for version, first, last, probed, _, _ in promising:
+            if version == 4:
+                values = (v for v in range(first, last + 1) if v not in probed)
+            else:
+                values = random_samples(first, last, adaptive_dense_samples, probed)
+            for value in values:
+                if budget <= 0:
+                    return
+                budget -= 1
+                yield int_to_ip(version, value)
+
+    await pipeline.probe_many(expansion())
+    working = len(pipeline.ip_info)
+    probes = adaptive_budget - budget
+    logger.info(f"Adaptive scan: {probes} probes, {working} working IPs"
+                + (f", {probes / working:.1f} probes per working IP" if working else ""))
+
+# 断点续扫日志（JSONL，只追加）：第一行记录输入，之后每行是一个 (IP, 阶段) 的结果
+# readonly=True 时只读取已有结果，不写文件（多进程模式下由父进程统一写入）
+class ScanJournal:
+    def __init__(self, path, input_key, resume=False, readonly=False):
+        self.path = path
+        self.done = {}  # ip -> {阶段: 结果}
+        self.recorded = set()  # 已写入历史库的IP，续扫后不再重复记录
+        self.recorded_tested = 0  # 已写入历史库的运行中测试过的IP数
+        self.file = None
+        if readonly:
+            if os.path.exists(path):
+                self._load(input_key)
+        elif resume and os.path.exists(path):
+            self._load(input_key)
+            self.file = open(path, 'a', encoding='utf-8')
+        else:
+            if resume:
+                logger.warning(f"⚠️ Journal {path} not found, starting a new scan")
+            self.file = open(path, 'w', encoding='utf-8')
+            self._write({'stage': 'start', 'input': input_key, 'started_at': time.time()})
+
+    def _load(self, input_key):
+        path = self.path
+        with open(path, 'r', encoding='utf-8') as f:
+            header = None
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程被杀时最后一行可能不完整
+                    continue
+                if header is None:
+                    header = entry
+                    if input_key is not None and header.get('input') != input_key:
+                        raise SystemExit(f"Journal {path} belongs to a different input, remove it or run without --resume")
+                    continue
+                if entry['stage'] == 'history':
+                    self.recorded.update(entry['ips'])
+                    self.recorded_tested += entry['tested']
+                    continue
+                self.done.setdefault(entry['ip'], {})[entry['stage']] = entry['result']
+        logger.info(f"Resuming from {path}: {len(self.done)} IPs already have results")
+
+    def _write(self, entry):
+        if self.file is None:
+            return
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def get(self, ip, stage):
+        return self.done.get(ip, {}).get(stage)
+
+    def record(self, ip, stage, result):
+        if stage in self.done.get(ip, {}):
+            return
+        self.done.setdefault(ip, {})[stage] = result
+        self._write({'ip': ip, 'stage': stage, 'result': result})
+
+    # 记下已写入历史库某次运行的IP和测试数
+    def mark_recorded(self, run_id, tested, ips):
+        ips = [ip for ip in ips if ip not in self.recorded]
+        self.recorded.update(ips)
+        self.recorded_tested += tested
+        self._write({'stage': 'history', 'run_id': run_id, 'tested': tested, 'ips': ips})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+# 流水线：IP通过HTTP测试后立即送入地理位置、代理检查、延迟测试阶段
+# 各阶段独立并发，队列有界形成背压
+class ScanPipeline:
+    stage_runners = {
+        'geo': 'run_geo_stage',
+        'proxy': 'run_proxy_stage',
+        'latency': 'run_latency_stage',
+    }
+
+    # stages 为HTTP测试之后要运行的阶段；emit 不为空时，完成的IP交给 emit 而不是在本进程合并
+    def __init__(self, colo_mapping, cache=None, journal=None, stages=None, emit=None):
+        if stages is None:
+            stages = ('geo', 'proxy', 'latency') if proxy_check else ('geo', 'latency')
+        self.colo_mapping = colo_mapping
+        self.cache = cache
+        self.journal = journal
+        self.emit = emit
+        self.controller = None  # 自适应并发控制器（未启用时为 None）
+        self.worker_args = None  # 多进程模式下传给子进程的命令行参数
+        self.worker_settings = {}  # 在子进程中额外覆盖的配置（命令行参数无法设置的部分，如压测时的替身端口），见 shard_settings
+        self.loop = asyncio.get_running_loop()
+        self.start_time = self.loop.time()
+        self.first_result_at = None
+        self.stage_times = {}   # 阶段 -> 从流水线开始到该阶段结束的秒数
+        self.confirmed = 0      # 延迟测试后满足 find_max_delay 的IP数
+        self.found = asyncio.Event()  # 已找到 find_count 个IP，停止发起新的探测
+        self.known = None       # 需要记录失败的IP（历史库中曾经可用的IP）
+        self.failed_known = []  # 本次失败的已知IP
+        self.tested = 0
+        self.ip_info = {}       # 通过HTTP测试的IP -> 状态信息
+        self.partial = {}       # 尚未完成所有阶段的IP -> 各阶段结果
+        self.results = []       # 已完成所有阶段的合并结果
+        self.stage_queues = {stage: asyncio.Queue(maxsize=stage_queue_size) for stage in stages}
+
+    # HTTP测试阶段：ip_ranges 为 IpRangeSet，按 scan_mode 逐个或分层测试
+    async def run_http_stage(self, ip_ranges):
+        if worker_processes > 1:
+            await run_sharded(self, ip_ranges)
+            return
+        control_task = None
+        if adaptive_concurrency:
+            self.controller = ConcurrencyController(initial_concurrency, min_concurrency, concurrency_limit)
+            self.semaphore = self.controller
+            control_task = asyncio.create_task(self.controller.run())
+        else:
+            self.semaphore = asyncio.Semaphore(concurrency_limit)
+        try:
+            session = RawProbeSession() if probe_engine == 'raw' else create_probe_session()
+            async with session:
+                self.session = session
+                if scan_mode == 'adaptive':
+                    await adaptive_scan(self, ip_ranges)
+                else:
+                    await self.probe_many(ip_ranges)
+        finally:
+            if control_task is not None:
+                control_task.cancel()
+
+    # 测试一组IP（任意可迭代对象，按需取地址），on_result 接收每个 test_ip 结果
+    async def probe_many(self, ips, on_result=None):
+        # 限制已创建的任务数，避免一次性为所有IP创建任务
+        task_slots = asyncio.Semaphore(concurrency_limit * 2)
+        tasks = set()
+
+        # 找够IP后取消仍在进行的探测
+        async def cancel_when_found():
+            await self.found.wait()
+            for task in list(tasks):
+                task.cancel()
+
+        # 探测任务出错（如日志写入失败）时记下第一个异常，停止发起新的探测并抛出
+        failure = self.loop.create_future()
+        drained = None  # 发起完所有探测后创建，剩余探测全部结束时完成
+
+        def finished(task):
+            tasks.discard(task)
+            task_slots.release()
+            if not task.cancelled() and task.exception() is not None and not failure.done():
+                failure.set_exception(task.exception())
+            if not tasks and drained is not None and not drained.done():
+                drained.set_result(None)
+
+        canceller = asyncio.create_task(cancel_when_found())
+        try:
+            for ip in ips:
+                await task_slots.acquire()
+                if self.found.is_set() or failure.done():
+                    break
+                task = asyncio.create_task(self.probe(ip, on_result))
+                tasks.add(task)
+                task.add_done_callback(finished)
+            if tasks and not failure.done():
+                drained = self.loop.create_future()
+                await asyncio.wait([drained, failure], return_when=asyncio.FIRST_COMPLETED)
+            if failure.done():
+                failure.result()
+        finally:
+            canceller.cancel()
+            for task in list(tasks):
+                task.cancel()
+
+    async def probe(self, ip, on_result=None):
+        # 续扫时直接使用日志中的结果
+        result = self.journal.get(ip, 'http') if self.journal is not None else None
+        if result is None:
+            result = await test_ip(self.session, ip, self.semaphore)
+            if self.controller is not None:
+                self.controller.observe(result[4])
+        await self.accept(tuple(result), on_result)
+
+    # 接收一个HTTP测试结果；known 为已经得到的下游阶段结果（来自子进程或日志）
+    async def accept(self, result, on_result=None, known=None):
+        ip, success, status, response_text, elapsed = result[:5]
+        # 旧版本日志中的结果没有各阶段耗时和机房
+        timings = result[5] if len(result) > 5 else {}
+        colo = result[6] if len(result) > 6 else None
+        if self.journal is not None:
+            self.journal.record(ip, 'http', result)
+        self.tested += 1
+        if on_result is not None:
+            on_result(result)
+        if not success:
+            if self.known is not None and ip in self.known:
+                self.failed_known.append(ip)
+            if self.emit is not None:
+                self.emit(result, None)
+            return
+        self.ip_info[ip] = {
             'status': status,
-            'response_text': response_text
+            'response_text': response_text,
+            'probe_time': elapsed,
+            'timings': timings,
+            'colo': colo,
         }
-    
-    # 如果没有可用IP，直接退出
-    if not working_ips:
-        logger.info("\nNo working IPs found.")
-        return
-    
-    # 查询可用IP的地理位置（分批处理）
-    geo_results = []
-    logger.info(f"\nFound {len(working_ips)} working IPs. Querying location in batches...")
-    
-    # 分批处理（每批最多45个IP）
-    batches = [working_ips[i:i + batch_size] for i in range(0, len(working_ips), batch_size)]
-    total_batches = len(batches)
-    
-    geo_sem = asyncio.Semaphore(geo_concurrency)
-    
-    for batch_num, batch in enumerate(batches, 1):
-        logger.info(f"\nProcessing location batch {batch_num}/{total_batches} ({len(batch)} IPs)")
-        
-        # 处理当前批次
-        batch_tasks = []
+        self.partial[ip] = {}
+        try:
+            for stage, queue in self.stage_queues.items():
+                done = (known or {}).get(stage)
+                if done is None and self.journal is not None:
+                    done = self.journal.get(ip, stage)
+                if done is not None:
+                    self.complete(ip, stage, done)
+                else:
+                    # 下游队列满时在此等待（背压）
+                    await queue.put(ip)
+        except asyncio.CancelledError:
+            # 找够IP后取消探测时，只进入了部分队列的IP不会完成所有阶段，整体放弃，
+            # 否则会计入可用IP却不出现在结果中；HTTP结果已写入日志，续扫时会补齐
+            del self.ip_info[ip]
+            del self.partial[ip]
+            raise
+
+    # 地理位置阶段：攒够一批（最多 geo_batch_size 个）后调用批量接口
+    # 上一批等待令牌期间新到的IP会进入下一批
+    async def run_geo_stage(self):
+        queue = self.stage_queues['geo']
+        if geo_backend == 'offline':
+            # 本地查询不需要批量和限速
+            offline = load_offline_geo(geo_db_file)
+            while True:
+                ip = await queue.get()
+                if ip is None:
+                    return
+                with metrics.track('geo'):
+                    self.complete(ip, 'geo', offline.lookup(ip))
+        limiter = TokenBucket(geo_rate_limit, geo_rate_period)
+        semaphore = asyncio.Semaphore(geo_concurrency)
+        tasks = set()
+        finished = False
+
+        async def lookup(batch):
+            try:
+                for result in await query_geo(session, batch, limiter, self.cache):
+                    self.complete(result['ip'], 'geo', result)
+            finally:
+                semaphore.release()
+
         async with aiohttp.ClientSession() as session:
-            for ip in batch:
-                task = asyncio.create_task(query_geo(session, ip, geo_sem))
-                batch_tasks.append(task)
-            
-            batch_results = await asyncio.gather(*batch_tasks)
-            geo_results.extend(batch_results)
-        
-        # 如果不是最后一批，等待一段时间
-        if batch_num < total_batches:
-            logger.info(f"Waiting {batch_delay} seconds before next batch...")
-            await asyncio.sleep(batch_delay)
-    
-    # 检查代理信息（分批处理）
-    proxy_results = []
-    logger.info(f"\nChecking proxy info for {len(working_ips)} IPs in batches...")
-    
-    proxy_batches = [working_ips[i:i + batch_size] for i in range(0, len(working_ips), batch_size)]
-    proxy_total_batches = len(proxy_batches)
-    
-    proxy_sem = asyncio.Semaphore(proxy_concurrency)
-    
-    for batch_num, batch in enumerate(proxy_batches, 1):
-        logger.info(f"\nProcessing proxy batch {batch_num}/{proxy_total_batches} ({len(batch)} IPs)")
-        
-        # 处理当前批次
-        batch_tasks = []
+            while not finished:
+                ip = await queue.get()
+                if ip is None:
+                    break
+                await semaphore.acquire()
+                batch = [ip]
+                while len(batch) < geo_batch_size:
+                    try:
+                        ip = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if ip is None:
+                        finished = True
+                        break
+                    batch.append(ip)
+                task = asyncio.create_task(lookup(batch))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+
+    # 代理检查阶段：固定数量的工作协程，未命中缓存的请求先取令牌
+    async def run_proxy_stage(self):
+        queue = self.stage_queues['proxy']
+        limiter = TokenBucket(proxy_rate_limit, proxy_rate_period)
+        semaphore = asyncio.Semaphore(proxy_concurrency)
+
+        async def worker():
+            while True:
+                ip = await queue.get()
+                if ip is None:
+                    queue.put_nowait(None)
+                    return
+                self.complete(ip, 'proxy', await check_proxy(session, ip, semaphore, limiter, self.cache))
+
         async with aiohttp.ClientSession() as session:
-            for ip in batch:
-                task = asyncio.create_task(check_proxy(session, ip, proxy_sem))
-                batch_tasks.append(task)
-            
-            batch_results = await asyncio.gather(*batch_tasks)
-            proxy_results.extend(batch_results)
-        
-        # 如果不是最后一批，等待一段时间
-        if batch_num < proxy_total_batches:
-            logger.info(f"Waiting {batch_delay} seconds before next batch...")
-            await asyncio.sleep(batch_delay)
-    
-    # 合并所有信息
-    combined_results = []
-    for geo in geo_results:
-        ip = geo['ip']
-        proxy = next((p for p in proxy_results if p['ip'] == ip), None)
-        info = ip_info.get(ip, {})
+            await asyncio.gather(*(worker() for _ in range(proxy_concurrency)))
+
+    # 延迟测试阶段：固定数量的工作协程从队列取IP
+    async def run_latency_stage(self):
+        queue = self.stage_queues['latency']
+        pinger = IcmpPinger()
+        if not pinger.available:
+            pinger.close()
+            pinger = None
+            logger.info(f"No ICMP permission, measuring latency via TCP connect to port {latency_port}")
+        else:
+            for family, name in ((socket.AF_INET, 'IPv4'), (socket.AF_INET6, 'IPv6')):
+                if family not in pinger.sockets:
+                    logger.info(f"No ICMP socket for {name}, measuring its latency via TCP connect to port {latency_port}")
+        semaphore = asyncio.Semaphore(latency_concurrency)
+
+        async def worker():
+            while True:
+                ip = await queue.get()
+                if ip is None:
+                    # 把结束标记传给其他工作协程
+                    queue.put_nowait(None)
+                    return
+                self.complete(ip, 'latency', await measure_latency(ip, semaphore, pinger))
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(latency_concurrency)))
+        finally:
+            if pinger is not None:
+                pinger.close()
+
+    # 记录某个阶段的结果，所有阶段完成后合并输出
+    def complete(self, ip, stage, result):
+        if self.journal is not None:
+            self.journal.record(ip, stage, result)
+        if stage == 'latency' and find_count and not self.found.is_set():
+            if find_max_delay is None or result['ping_delay'] <= find_max_delay:
+                self.confirmed += 1
+                if self.confirmed >= find_count:
+                    logger.info(f"🎯 Found {self.confirmed} IPs"
+                                + (f" within {find_max_delay}ms" if find_max_delay is not None else "")
+                                + ", stopping the HTTP stage")
+                    self.found.set()
+        stages = self.partial.get(ip)
+        if stages is None:
+            return  # 入队时被取消而放弃的IP（见 accept）
+        stages[stage] = result
+        if len(stages) < len(self.stage_queues):
+            return
+        del self.partial[ip]
+        if self.emit is not None:
+            info = self.ip_info[ip]
+            self.emit((ip, True, info['status'], info['response_text'], info['probe_time'], info['timings'], info['colo']), stages)
+            return
+        combined = self.combine(ip, stages['geo'], stages.get('proxy', {}), stages['latency'])
+        self.results.append(combined)
+
+        if self.first_result_at is None:
+            self.first_result_at = self.loop.time()
+            logger.info(f"First usable result after {self.first_result_at - self.start_time:.2f} seconds")
+
+        # 输出详细日志
+        location = f"{combined['country']}, {combined['region']}, {combined['city']}"
+        ip_logger.info(f"IP: {ip}, 状态码: {combined['status']}, 地理位置: {location}, "
+              f"机房: {combined['colo_chinese']}, 延迟: {combined['ping_delay']} ms, "
+              f"代理可用: {'是' if combined['proxy_available'] else '否'}, "
+              f"代理端口: {combined['proxy_port']}")
+
+    # 合并单个IP的所有信息
+    def combine(self, ip, geo, proxy, latency):
+        info = self.ip_info.get(ip, {})
         
-        # 获取机房中文名称
-        colo_code = proxy.get('colo', 'N/A') if proxy else 'N/A'
-        colo_chinese = get_colo_chinese(colo_code, colo_mapping)
+        # 获取机房中文名称：优先用HTTP测试时得到的机房，没有时用代理检查的结果
+        colo_code = info.get('colo') or proxy.get('colo', 'N/A')
+        colo_chinese = get_colo_chinese(colo_code, self.colo_mapping)
         
-        # 合并数据
-        combined = {
+        row = {
             'ip': ip,
             'status': info.get('status', 0),
             'response_text': info.get('response_text', ''),
@@ -455,31 +2080,778 @@ async def main():
             'region': geo.get('region', 'N/A'),
             'city': geo.get('city', 'N/A'),
             'isp': geo.get('isp', 'N/A'),
-            'proxy_available': proxy.get('proxy_available', False) if proxy else False,
-            'proxy_port': proxy.get('proxy_port', -1) if proxy else -1,
+            'asn': geo.get('asn', 'N/A'),
+            'proxy_available': proxy.get('proxy_available', False),
+            'proxy_port': proxy.get('proxy_port', -1),
             'colo_code': colo_code,  # 原始代码
             'colo_chinese': colo_chinese,  # 中文名称
-            'response_time': proxy.get('response_time', -1) if proxy else -1
+            'response_time': proxy.get('response_time', -1),
+            'ping_delay': latency['ping_delay'],
+            'ping_min': latency['ping_min'],
+            'ping_jitter': latency['ping_jitter'],
+            'ping_loss': latency['ping_loss'],
         }
+        # HTTP测试中各阶段耗时的百分位
+        for phase in timing_phases:
+            for p in ('p50', 'p90'):
+                row[f'{phase}_{p}'] = info.get('timings', {}).get(f'{phase}_{p}', float('inf'))
+        return row
+
+    # 运行一个阶段并记录其结束时间
+    async def timed(self, stage, runner):
+        try:
+            await runner
+        finally:
+            self.stage_times[stage] = round(self.loop.time() - self.start_time, 3)
+
+    # sampled 日志模式下定期输出进度汇总
+    async def report_progress(self):
+        while True:
+            await asyncio.sleep(log_interval)
+            logger.info(f"📊 {self.tested} tested, {len(self.results)} completed | {metrics.progress()}")
+
+    async def run(self, ip_ranges):
+        downstream = [asyncio.create_task(self.timed(stage, getattr(self, self.stage_runners[stage])()))
+                      for stage in self.stage_queues]
+        monitors = [asyncio.create_task(metrics.watch(self.stage_queues))]
+        if log_mode == 'sampled' and self.emit is None:
+            monitors.append(asyncio.create_task(self.report_progress()))
+
+        async def http_stage():
+            await self.timed('http', self.run_http_stage(ip_ranges))
+            logger.info(f"\nHTTP stage finished: {len(self.ip_info)} working IPs, waiting for downstream stages...")
+            for queue in self.stage_queues.values():
+                await queue.put(None)
+
+        stages = [asyncio.create_task(http_stage())] + downstream
+        try:
+            # 任一阶段出错立即停止，否则HTTP阶段会在出错阶段已满的队列上一直等待
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            tasks = stages + monitors
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+# 通过指定IP下载测速，边读边丢弃，不缓存响应体
+# 速率从收到第一个数据块开始计算，不含连接和TLS握手
+async def speed_test(session, ip, semaphore):
+    result = {'speed_mbps': 0.0, 'first_mb_ms': float('inf'), 'downloaded_mb': 0.0}
+    async with semaphore:
+        start = time.monotonic()
+        body_start = None
+        downloaded = 0
+        try:
+            async with session.get(
+                pinned_url(ip, speed_test_path),
+                server_hostname=domain,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout),
+            ) as response:
+                if response.status != 200:
+                    logger.warning(f"❌ Speed test: {ip} | Status: {response.status}")
+                    return result
+                async for chunk in response.content.iter_chunked(speed_test_chunk):
+                    now = time.monotonic()
+                    if body_start is None:
+                        body_start = now
+                    downloaded += len(chunk)
+                    if result['first_mb_ms'] == float('inf') and downloaded >= 1024 * 1024:
+                        result['first_mb_ms'] = round((now - start) * 1000, 2)
+                    if downloaded >= speed_test_bytes or now - start >= speed_test_duration:
+                        break
+        except Exception as e:
+            logger.error(f"⚠️ Speed test error: {ip} | {str(e)}")
+
+        if body_start is not None:
+            duration = time.monotonic() - body_start
+            if duration > 0:
+                result['speed_mbps'] = round(downloaded * 8 / duration / 1e6, 2)
+        result['downloaded_mb'] = round(downloaded / 1024 / 1024, 2)
+        logger.info(f"📶 Speed test: {ip} | {result['speed_mbps']} Mbit/s | "
+                    f"first MB {result['first_mb_ms']} ms | {result['downloaded_mb']} MB")
+        return result
+
+# 对排序后的前 speed_test_top 个IP测速，结果写回行中
+async def run_speed_stage(rows):
+    rows = rows[:speed_test_top]
+    logger.info(f"\nSpeed testing top {len(rows)} IPs...")
+    semaphore = asyncio.Semaphore(speed_test_concurrency)
+    async with create_probe_session() as session:
+        results = await asyncio.gather(*(speed_test(session, row['ip'], semaphore) for row in rows))
+    for row, result in zip(rows, results):
+        row.update(result)
+
+# 子进程入口：测试一个分片，结果分批通过 result_queue 发回主进程
+# budget 为该分片的自适应扫描探测预算，各分片按地址数分摊 adaptive_budget
+# log_disable 为父进程的 logging.disable 级别，spawn 出的子进程不会继承
+def shard_worker(args, index, intervals, result_queue, settings=None, budget=None, log_disable=logging.NOTSET):
+    global worker_processes, adaptive_budget
+    logging.disable(log_disable)
+    apply_args(args)
+    globals().update({name: value for name, value in (settings or {}).items() if name in shard_settings})
+    worker_processes = 1
+    if budget is not None:
+        adaptive_budget = budget
+    if use_uvloop:
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            logger.warning("⚠️ uvloop not installed, using the default event loop")
+    asyncio.run(run_shard(args, index, IpRangeSet(intervals), result_queue))
+
+async def run_shard(args, index, ip_ranges, result_queue):
+    buffer = []
+    journal = ScanJournal(args.journal, None, readonly=True) if args.resume else None
+    pipeline = ScanPipeline(None, journal=journal, stages=('latency',),
+                            emit=lambda result, stages: buffer.append((result, stages)))
+
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(0.2)
+            flush()
+
+    def flush():
+        nonlocal buffer
+        if buffer:
+            result_queue.put(('results', buffer))
+            buffer = []
+        result_queue.put(('metrics', {'shard': index, 'snapshot': metrics.snapshot()}))
+
+    flusher = asyncio.create_task(flush_periodically())
+    try:
+        await pipeline.run(ip_ranges)
+    finally:
+        flusher.cancel()
+        flush()
+        summary = pipeline.controller.summary() if pipeline.controller is not None else None
+        result_queue.put(('done', {'shard': index, 'tested': pipeline.tested, 'concurrency': summary}))
+
+# 多进程HTTP测试：按地址数把IP集合分给子进程，子进程完成HTTP和延迟测试，
+# 结果流回主进程的流水线继续做地理位置和代理检查
+async def run_sharded(pipeline, ip_ranges):
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    shards = ip_ranges.split(worker_processes)
+    unknown = set(pipeline.worker_settings) - set(shard_settings)
+    if unknown:
+        raise ValueError(f"Settings not allowed in worker processes: {', '.join(sorted(unknown))}")
+    logger.info(f"Scanning with {len(shards)} worker processes")
+    total = ip_ranges.count
+    processes = [
+        ctx.Process(target=shard_worker, args=(pipeline.worker_args, index, shard.intervals, result_queue,
+                                                  pipeline.worker_settings, max(1, adaptive_budget * shard.count // total),
+                                                  logging.root.manager.disable),
+                    daemon=True)
+        for index, shard in enumerate(shards)
+    ]
+    for process in processes:
+        process.start()
+
+    def receive():
+        while True:
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                # 子进程异常退出时不会发送 done
+                if not any(process.is_alive() for process in processes):
+                    return None
+
+    remaining = len(processes)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            while remaining and not pipeline.found.is_set():
+                message = await pipeline.loop.run_in_executor(executor, receive)
+                if message is None:
+                    logger.error(f"⚠️ {remaining} worker processes exited without finishing")
+                    break
+                kind, payload = message
+                if kind == 'results':
+                    for result, stages in payload:
+                        await pipeline.accept(tuple(result), known=stages)
+                elif kind == 'metrics':
+                    metrics.merge(payload['shard'], payload['snapshot'])
+                else:
+                    remaining -= 1
+                    logger.info(f"Worker {payload['shard']} finished: {payload['tested']} IPs tested"
+                                + (f", concurrency {payload['concurrency']}" if payload['concurrency'] else ""))
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+# 协调者：每个观测点（vantage）都要完成全部工作单元，同一观测点的多个 worker 分摊单元
+# 地理位置和代理检查只在协调者上对每个IP做一次
+# 工作单元数：full 模式按地址数切分；adaptive 模式按子网分组，大网段不必逐个地址切分
+def unit_count(ip_ranges):
+    if scan_mode == 'adaptive':
+        subnets = sum((last >> (8 if version == 4 else 80)) - (first >> (8 if version == 4 else 80)) + 1
+                      for version, first, last in ip_ranges.intervals)
+        return -(-subnets // coordinator_unit_subnets)
+    return max(1, -(-ip_ranges.count // coordinator_unit_size))
+
+class Coordinator:
+    def __init__(self, ip_ranges, pipeline, expect_vantages=1):
+        if scan_mode == 'adaptive':
+            subnets = iter_subnets(ip_ranges.intervals)
+            chunks = iter(lambda: list(itertools.islice(subnets, coordinator_unit_subnets)), [])
+        else:
+            chunks = (shard.intervals for shard in ip_ranges.split(unit_count(ip_ranges)))
+        self.units = dict(enumerate(chunks))
+        self.pipeline = pipeline
+        self.expect_vantages = expect_vantages
+        self.vantages = {}       # 观测点 -> 单元状态
+        self.latency = {}        # ip -> {观测点: 延迟结果}
+        self.tested = collections.Counter()  # 观测点 -> 已测试IP数
+        self.finished = asyncio.Event()
+
+    def _vantage(self, name):
+        if name not in self.vantages:
+            logger.info(f"Vantage {name} joined, {len(self.units)} work units queued for it")
+            self.vantages[name] = {
+                'pending': collections.deque(self.units),
+                'leased': {},    # 单元 -> (worker, 到期时间)
+                'attempts': collections.Counter(),
+                'done': set(),
+                'failed': set(),
+            }
+        return self.vantages[name]
+
+    def _check_finished(self):
+        if len(self.vantages) < self.expect_vantages:
+            return
+        if all(not v['pending'] and not v['leased'] for v in self.vantages.values()):
+            self.finished.set()
+
+    # 把过期的租约放回队列
+    def expire_leases(self):
+        now = time.monotonic()
+        for name, vantage in self.vantages.items():
+            for unit_id, (worker, expires_at) in list(vantage['leased'].items()):
+                if expires_at > now:
+                    continue
+                del vantage['leased'][unit_id]
+                if vantage['attempts'][unit_id] >= coordinator_max_attempts:
+                    vantage['failed'].add(unit_id)
+                    logger.error(f"⚠️ Unit {unit_id} for {name} failed {coordinator_max_attempts} times, giving up")
+                else:
+                    vantage['pending'].appendleft(unit_id)
+                    logger.warning(f"⚠️ Lease on unit {unit_id} expired ({name}/{worker}), requeued")
+        self._check_finished()
+
+    async def handle_lease(self, request):
+        body = await request.json()
+        if self.finished.is_set():
+            return web.json_response({'done': True})
+        vantage = self._vantage(body['vantage'])
+        if not vantage['pending']:
+            # 还有单元在其他 worker 手里，稍后再来（租约过期后可能重新分配）
+            return web.json_response({'wait': 2})
+        unit_id = vantage['pending'].popleft()
+        vantage['attempts'][unit_id] += 1
+        vantage['leased'][unit_id] = (body['worker'], time.monotonic() + coordinator_lease)
+        return web.json_response({'unit': unit_id, 'intervals': self.units[unit_id], 'lease': coordinator_lease})
+
+    async def handle_heartbeat(self, request):
+        body = await request.json()
+        vantage = self._vantage(body['vantage'])
+        lease = vantage['leased'].get(body['unit'])
+        if lease is None or lease[0] != body['worker']:
+            return web.json_response({'ok': False})
+        vantage['leased'][body['unit']] = (lease[0], time.monotonic() + coordinator_lease)
+        return web.json_response({'ok': True})
+
+    async def handle_complete(self, request):
+        body = await request.json()
+        name = body['vantage']
+        vantage = self._vantage(name)
+        unit_id = body['unit']
+        # 租约过期后又被别人完成的单元，重复提交直接忽略
+        if unit_id in vantage['done']:
+            return web.json_response({'ok': True})
+        vantage['leased'].pop(unit_id, None)
+        if unit_id in vantage['pending']:
+            vantage['pending'].remove(unit_id)
+        vantage['failed'].discard(unit_id)
+        vantage['done'].add(unit_id)
+        self.tested[name] += body['tested']
+        for result, stages in body['results']:
+            ip = result[0]
+            self.latency.setdefault(ip, {})[name] = stages['latency']
+            # 每个IP只在第一次可用时做地理位置和代理检查
+            if ip not in self.pipeline.ip_info:
+                await self.pipeline.accept(tuple(result), known={})
+        logger.info(f"Unit {unit_id} done by {name}/{body['worker']} "
+                    f"({len(vantage['done'])}/{len(self.units)} for {name})")
+        self._check_finished()
+        return web.json_response({'ok': True})
+
+    async def handle_status(self, request):
+        return web.json_response({
+            name: {
+                'pending': len(v['pending']),
+                'leased': len(v['leased']),
+                'done': len(v['done']),
+                'failed': len(v['failed']),
+                'tested': self.tested[name],
+            }
+            for name, v in self.vantages.items()
+        })
+
+    def make_app(self):
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post('/lease', self.handle_lease)
+        app.router.add_post('/heartbeat', self.handle_heartbeat)
+        app.router.add_post('/complete', self.handle_complete)
+        app.router.add_get('/status', self.handle_status)
+        app.router.add_get('/metrics', handle_metrics)
+        return app
+
+    # 合并各观测点的结果：主延迟取最好的观测点，另附每个观测点的延迟和可用比例
+    def rows(self, geo_proxy):
+        names = sorted(self.vantages)
+        rows = []
+        for ip, stages in geo_proxy.items():
+            per_vantage = self.latency.get(ip, {})
+            best = min(per_vantage.values(), key=lambda x: x['ping_delay'])
+            row = self.pipeline.combine(ip, stages['geo'], stages.get('proxy', {}), best)
+            row['best_vantage'] = min(per_vantage, key=lambda v: per_vantage[v]['ping_delay'])
+            row['available_vantages'] = f"{len(per_vantage)}/{len(names)}"
+            row['vantage_delays'] = ";".join(
+                f"{name}:{per_vantage[name]['ping_delay']}" if name in per_vantage else f"{name}:-"
+                for name in names
+            )
+            rows.append(row)
+        return rows
+
+async def run_coordinator(args):
+    host, _, port = args.coordinator.rpartition(':')
+    ip_ranges = load_ip_ranges(args.input)
+    if not ip_ranges:
+        logger.error(f"No valid IP addresses found in {args.input}")
+        return
+    units = unit_count(ip_ranges)
+    if units > coordinator_max_units:
+        logger.error(f"⚠️ {args.input} would need {units} work units, the coordinator handles at most {coordinator_max_units}"
+                     + ("" if scan_mode == 'adaptive' else ", use --mode adaptive for large ranges"))
+        return
+
+    cache = ResultCache(cache_file) if cache_file else None
+    geo_proxy = {}
+    pipeline = ScanPipeline(load_colo_mapping(), cache, stages=('geo', 'proxy') if proxy_check else ('geo',),
+                            emit=lambda result, stages: geo_proxy.__setitem__(result[0], stages))
+    coordinator = Coordinator(ip_ranges, pipeline, args.expect_vantages)
+    downstream = [asyncio.create_task(getattr(pipeline, pipeline.stage_runners[stage])())
+                  for stage in pipeline.stage_queues]
+
+    runner = web.AppRunner(coordinator.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host or '0.0.0.0', int(port)).start()
+    logger.info(f"Coordinator listening on {args.coordinator}: {ip_ranges.count} IPs in "
+                f"{len(coordinator.units)} units, waiting for {args.expect_vantages} vantage(s)")
+
+    async def expire_loop():
+        while True:
+            await asyncio.sleep(1)
+            coordinator.expire_leases()
+
+    expirer = asyncio.create_task(expire_loop())
+    watcher = asyncio.create_task(metrics.watch(pipeline.stage_queues))
+    try:
+        await coordinator.finished.wait()
+        logger.info("\nAll units finished, waiting for geo/proxy stages...")
+        for stage_queue in pipeline.stage_queues.values():
+            await stage_queue.put(None)
+        await asyncio.gather(*downstream)
+        # 给仍在轮询的 worker 一点时间拿到 done
+        await asyncio.sleep(2)
+    finally:
+        expirer.cancel()
+        watcher.cancel()
+        for task in downstream:
+            task.cancel()
+        await runner.cleanup()
+        if cache is not None:
+            cache.close()
+
+    rows = sort_results(coordinator.rows(geo_proxy))
+    logger.info(f"Tested per vantage: {dict(coordinator.tested)}, working IPs: {len(rows)}")
+    if rows:
+        write_results_csv(rows, fields=csv_fields + ['best_vantage', 'available_vantages', 'vantage_delays'])
+
+# worker：向协调者租工作单元，完成HTTP和延迟测试后提交结果，直到协调者返回 done
+async def run_worker(args):
+    base = args.worker.rstrip('/')
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    identity = {'vantage': args.vantage, 'worker': worker_id}
+    logger.info(f"Worker {worker_id} joining {base} as vantage {args.vantage}")
+    if metrics_port:
+        await start_metrics_server(metrics_host, metrics_port)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        async def call(path, payload):
+            # 协调者暂时不可达时退避重试
+            for attempt in itertools.count():
+                try:
+                    async with session.post(base + path, json=payload) as response:
+                        response.raise_for_status()
+                        return await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    delay = min(30, 2 ** attempt)
+                    logger.warning(f"⚠️ Coordinator {path} failed ({e}), retrying in {delay}s")
+                    await asyncio.sleep(delay)
+
+        while True:
+            lease = await call('/lease', identity)
+            if lease.get('done'):
+                logger.info("Coordinator reports all work done, exiting")
+                return
+            if 'wait' in lease:
+                await asyncio.sleep(lease['wait'])
+                continue
+
+            unit_id = lease['unit']
+            ip_ranges = IpRangeSet([tuple(x) for x in lease['intervals']])
+            results = []
+
+            # 只提交可用IP的结果，不可用的只计入 tested
+            def collect(result, stages):
+                if stages is not None:
+                    results.append((result, stages))
+
+            pipeline = ScanPipeline(None, stages=('latency',), emit=collect)
+            pipeline.worker_args = args
+
+            async def heartbeat():
+                while True:
+                    await asyncio.sleep(lease['lease'] / 3)
+                    await call('/heartbeat', dict(identity, unit=unit_id))
+
+            beat = asyncio.create_task(heartbeat())
+            try:
+                await pipeline.run(ip_ranges)
+            finally:
+                beat.cancel()
+            await call('/complete', dict(identity, unit=unit_id, tested=pipeline.tested, results=results))
+            logger.info(f"Unit {unit_id}: {pipeline.tested} tested, {len(results)} working")
+
+# 常驻模式的IP记分板：每个IP的最近结果和下次测试时间
+# 可用IP按 sort_key 排好序，并按机房、国家建立索引，查询时只需切片
+class IpScoreboard:
+    def __init__(self):
+        self.entries = {}    # ip -> {'row', 'failures', 'probes', 'successes', 'next_at'}
+        self.schedule = []   # (下次测试时间, ip) 小顶堆，重新安排后旧项在弹出时跳过
+        self.ranked = []
+        self.by_colo = {}
+        self.by_country = {}
+        self.rounds = 0
+        self.last_round_at = None
+
+    def _schedule(self, ip, at):
+        self.entries[ip]['next_at'] = at
+        heapq.heappush(self.schedule, (at, ip))
+
+    # 与IP列表文件同步：新增的IP立即测试，删除的IP不再测试
+    def sync(self, ip_ranges, now):
+        current = set(ip_ranges)
+        removed = [ip for ip in self.entries if ip not in current]
+        for ip in removed:
+            del self.entries[ip]
+        added = 0
+        for ip in current:
+            if ip not in self.entries:
+                self.entries[ip] = {'row': None, 'failures': 0, 'probes': 0, 'successes': 0, 'next_at': None}
+                self._schedule(ip, now)
+                added += 1
+        if removed:
+            self.rebuild()
+        return added, len(removed)
+
+    # 取出到期的IP，最多 limit 个
+    def due(self, now, limit):
+        ips = []
+        while self.schedule and self.schedule[0][0] <= now and len(ips) < limit:
+            at, ip = heapq.heappop(self.schedule)
+            entry = self.entries.get(ip)
+            if entry is not None and entry['next_at'] == at:
+                ips.append(ip)
+        return ips
+
+    # 下一个IP到期前的秒数
+    def next_due_in(self, now):
+        while self.schedule:
+            at, ip = self.schedule[0]
+            entry = self.entries.get(ip)
+            if entry is not None and entry['next_at'] == at:
+                return max(0.0, at - now)
+            heapq.heappop(self.schedule)
+        return None
+
+    # 记录一次测试结果：row 为合并后的结果，不可用时为 None
+    def update(self, ip, row, now):
+        entry = self.entries.get(ip)
+        if entry is None:
+            return
+        entry['probes'] += 1
+        if row is not None:
+            entry['row'] = row
+            entry['failures'] = 0
+            entry['successes'] += 1
+            self._schedule(ip, now + daemon_good_interval)
+        else:
+            entry['row'] = None
+            entry['failures'] += 1
+            self._schedule(ip, now + min(daemon_retry_max, daemon_retry_base * 2 ** (entry['failures'] - 1)))
+
+    # 重建排序和索引；inf 转为 None，便于输出 JSON
+    def rebuild(self):
+        rows = []
+        for ip, entry in self.entries.items():
+            if entry['row'] is None:
+                continue
+            row = {key: (None if value == float('inf') else value) for key, value in entry['row'].items()}
+            row['availability'] = round(entry['successes'] / entry['probes'], 3)
+            row['probes'] = entry['probes']
+            rows.append(row)
+        self.ranked = sorted(rows, key=lambda x: x[sort_key] if isinstance(x[sort_key], (int, float)) else float('inf'))
+        self.by_colo = {}
+        self.by_country = {}
+        for row in self.ranked:
+            self.by_colo.setdefault(str(row['colo_code']).upper(), []).append(row)
+            self.by_country.setdefault(row['country'], []).append(row)
+
+    def top(self, k, colo=None, country=None):
+        if colo and country:
+            rows = [row for row in self.by_colo.get(colo.upper(), []) if row['country'] == country]
+        elif colo:
+            rows = self.by_colo.get(colo.upper(), [])
+        elif country:
+            rows = self.by_country.get(country, [])
+        else:
+            rows = self.ranked
+        return rows[:k]
+
+    async def handle_best(self, request):
+        try:
+            k = int(request.query.get('k', daemon_top_k))
+        except ValueError:
+            return web.json_response({'error': 'k must be an integer'}, status=400)
+        if k < 0:
+            return web.json_response({'error': 'k must not be negative'}, status=400)
+        return web.json_response(self.top(k, request.query.get('colo'), request.query.get('country')))
+
+    async def handle_status(self, request):
+        return web.json_response({
+            'ips': len(self.entries),
+            'working': len(self.ranked),
+            'rounds': self.rounds,
+            'last_round_at': self.last_round_at,
+            'next_due_in': self.next_due_in(time.time()),
+        })
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/best', self.handle_best)
+        app.router.add_get('/status', self.handle_status)
+        app.router.add_get('/metrics', handle_metrics)
+        return app
+
+# IP字符串列表转为 IpRangeSet
+def ranges_of(ips):
+    intervals = []
+    for ip in ips:
+        address = ipaddress.ip_address(ip)
+        intervals.append((address.version, int(address), int(address)))
+    return IpRangeSet(intervals)
+
+# 常驻模式：每轮测试到期的IP，更新记分板；IP列表文件变化时重新加载
+# 地理位置和代理检查走本地缓存，只有缓存过期的IP才会再次查询
+async def run_daemon(args):
+    global scan_mode
+    host, _, port = args.daemon.rpartition(':')
+    # 到期的IP分散在各处，抽样没有意义
+    scan_mode = 'full'
+    board = IpScoreboard()
+    colo_mapping = load_colo_mapping()
+    cache = ResultCache(cache_file) if cache_file else None
+    history = HistoryStore(history_file) if history_file else None
+
+    runner = web.AppRunner(board.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host or '0.0.0.0', int(port)).start()
+    logger.info(f"Daemon listening on {args.daemon}: GET /best?k={daemon_top_k}&colo=LAX&country=美国")
+
+    mtime = None
+    evicted_at = time.time()
+    try:
+        while True:
+            try:
+                current = os.path.getmtime(args.input)
+            except OSError:
+                current = mtime
+            if current != mtime:
+                mtime = current
+                ip_ranges = load_ip_ranges(args.input)
+                if ip_ranges.count > daemon_max_ips:
+                    # 逐个展开后每个IP都占用内存，大网段请用普通扫描的 --mode adaptive
+                    logger.error(f"⚠️ {args.input} has {ip_ranges.count} IPs, daemon mode tracks at most {daemon_max_ips}"
+                                 + (", keeping the previous list" if board.entries else ""))
+                    if not board.entries:
+                        return
+                else:
+                    added, removed = board.sync(ip_ranges, time.time())
+                    logger.info(f"Loaded {args.input}: {added} new IPs, {removed} removed, {len(board.entries)} total")
+
+            due = board.due(time.time(), daemon_round_size)
+            if not due:
+                wait = board.next_due_in(time.time())
+                await asyncio.sleep(daemon_watch_interval if wait is None else min(wait, daemon_watch_interval))
+                continue
+
+            pipeline = ScanPipeline(colo_mapping, cache)
+            pipeline.worker_args = args
+            if history is not None:
+                pipeline.known = history.known
+            started_at = time.time()
+            await pipeline.run(ranges_of(due))
+            if history is not None:
+                history.record_run(started_at, None, pipeline.tested, pipeline.results, pipeline.failed_known)
+            rows = {row['ip']: row for row in pipeline.results}
+            now = time.time()
+            for ip in due:
+                board.update(ip, rows.get(ip), now)
+            board.rebuild()
+            if cache is not None:
+                cache.flush()
+                # 常驻进程不会退出，定期清理过期条目并按 cache_max_entries 淘汰
+                if now - evicted_at >= daemon_evict_interval:
+                    cache.evict()
+                    evicted_at = now
+            board.rounds += 1
+            board.last_round_at = now
+            best = board.ranked[0] if board.ranked else None
+            logger.info(f"Round {board.rounds}: {len(due)} probed, {len(rows)} working, {len(board.ranked)} ranked"
+                        + (f", best {best['ip']} ({best[sort_key]})" if best else ""))
+    finally:
+        await runner.cleanup()
+        if cache is not None:
+            cache.close()
+        if history is not None:
+            history.close()
+
+# 按延迟排序结果（从低到高），排序字段由 sort_key 指定
+def sort_results(rows):
+    return sorted(
+        rows, 
+        key=lambda x: x[sort_key] if not isinstance(x[sort_key], str) else float('inf')
+    )
+
+csv_fields = [
+    'ip', 'status', 'response_text', 'country', 'region', 'city', 'isp', 'asn',
+    'ping_delay', 'ping_min', 'ping_jitter', 'ping_loss', 'proxy_available', 'proxy_port', 'colo_code', 'colo_chinese', 'response_time'
+] + [f'{phase}_{p}' for phase in timing_phases for p in ('p50', 'p90')] + ['speed_mbps', 'first_mb_ms', 'downloaded_mb']
+
+# 保存结果到CSV文件
+def write_results_csv(rows, filename=None, fields=None):
+    if filename is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"working_ips_{timestamp}.csv"
+    
+    with open(filename, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=fields or csv_fields, extrasaction='ignore')
+        writer.writeheader()
         
-        # 添加ping延迟
-        ping_delay = ping_ip(ip)
-        combined['ping_delay'] = ping_delay
-        
-        combined_results.append(combined)
-        
-        # 输出详细日志
-        location = f"{combined['country']}, {combined['region']}, {combined['city']}"
-        logger.info(f"IP: {ip}, 状态码: {combined['status']}, 地理位置: {location}, "
-              f"机房: {combined['colo_chinese']}, 延迟: {combined['ping_delay']} ms, "
-              f"代理可用: {'是' if combined['proxy_available'] else '否'}, "
-              f"代理端口: {combined['proxy_port']}")
+        for row in rows:
+            writer.writerow(row)
     
-    # 按延迟排序结果（从低到高）
-    sorted_results = sorted(
-        combined_results, 
-        key=lambda x: x['ping_delay'] if not isinstance(x['ping_delay'], str) else float('inf')
-    )
+    logger.info(f"\nResults saved to {filename}")
+    return filename
+
+# 输入的唯一标识，用于确认续扫日志属于同一份输入
+def input_key(ip_ranges):
+    return hashlib.sha1(json.dumps(ip_ranges.intervals).encode()).hexdigest()
+
+# 查询历史库：按时间窗口内的可用率和延迟百分位排名，输出到日志或CSV
+def query_history(args):
+    if not history_file or not os.path.exists(history_file):
+        logger.error(f"History database {history_file} not found")
+        return
+    history = HistoryStore(history_file)
+    try:
+        since = time.time() - parse_duration(args.since)
+        rows = history.rank(since, args.colo, args.country, args.min_probes, args.top)
+    finally:
+        history.close()
+    if not rows:
+        logger.info(f"No IPs with results in the last {args.since}")
+        return
+    if args.csv:
+        write_results_csv(rows, args.csv, fields=['availability', 'probes', 'ping_p50', 'ping_p90'] + csv_fields)
+        return
+    logger.info(f"Top {len(rows)} IPs over the last {args.since}:")
+    for row in rows:
+        logger.info(f"{row['ip']:<40} 可用率 {row['availability']:.1%} ({row['probes']}次)  "
+                    f"延迟 p50 {row['ping_p50']} ms  p90 {row['ping_p90']} ms  "
+                    f"机房 {row['colo_chinese']}  {row['country']}")
+
+# 主异步函数
+async def main(args):
+    # 加载机房映射
+    colo_mapping = load_colo_mapping()
+    
+    # 读取IP列表（支持CIDR和IPv6，重叠网段自动合并）
+    ip_ranges = load_ip_ranges(args.input)
+    
+    if not ip_ranges:
+        logger.error(f"No valid IP addresses found in {args.input}")
+        return
+    
+    logger.info(f"Testing {ip_ranges.count} IP addresses in {len(ip_ranges.intervals)} merged ranges...")
+    start_time = time.time()
+    
+    # 运行流水线：HTTP测试 → 地理位置 / 代理检查 / 延迟测试
+    cache = ResultCache(cache_file) if cache_file else None
+    journal = ScanJournal(args.journal, input_key(ip_ranges), args.resume)
+    pipeline = ScanPipeline(colo_mapping, cache, journal)
+    pipeline.worker_args = args
+    history = HistoryStore(history_file) if history_file else None
+    if history is not None:
+        pipeline.known = history.known
+    metrics_runner = await start_metrics_server(metrics_host, metrics_port) if metrics_port else None
+    try:
+        await pipeline.run(ip_ranges)
+        if history is not None:
+            # 续扫时从日志重放的结果如果已在上次运行中写入历史库，不再重复记录，否则测试次数会翻倍
+            rows = [row for row in pipeline.results if row['ip'] not in journal.recorded]
+            failed = [ip for ip in pipeline.failed_known if ip not in journal.recorded]
+            tested = max(0, pipeline.tested - journal.recorded_tested)
+            if tested or rows or failed:
+                run_id = history.record_run(start_time, input_key(ip_ranges), tested, rows, failed)
+                journal.mark_recorded(run_id, tested, [row['ip'] for row in rows] + failed)
+    finally:
+        journal.close()
+        if history is not None:
+            history.close()
+        if cache is not None:
+            cache.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+    working_ips = list(pipeline.ip_info)
+    combined_results = pipeline.results
+    
+    # 如果没有可用IP，直接退出
+    if not working_ips:
+        logger.info("\nNo working IPs found.")
+        return
+    
+    sorted_results = sort_results(combined_results)
+    
+    # 对排名靠前的IP测速
+    if speed_test_top > 0:
+        await run_speed_stage(sorted_results)
     
     # 计算耗时
     elapsed = time.time() - start_time
@@ -487,9 +2859,9 @@ async def main():
     # 输出统计信息
     logger.info("\n" + "="*50)
     logger.info("Statistics:")
-    logger.info(f"Total IPs tested: {len(ip_list)}")
+    logger.info(f"Total IPs tested: {pipeline.tested}")
     logger.info(f"Working IPs found: {len(working_ips)}")
-    logger.info(f"Success rate: {len(working_ips)/len(ip_list)*100:.2f}%")
+    logger.info(f"Success rate: {len(working_ips)/pipeline.tested*100:.2f}%")
     
     # 计算平均延迟（仅统计可用的）
     if sorted_results:
@@ -507,25 +2879,84 @@ async def main():
         avg_proxy_time = sum(x['response_time'] for x in available_proxies) / len(available_proxies)
         logger.info(f"Average proxy response time: {avg_proxy_time:.2f}ms")
     
+    if pipeline.controller is not None:
+        logger.info(f"Concurrency: {pipeline.controller.summary()}")
+    speed_tested = [x for x in sorted_results if x.get('speed_mbps')]
+    if speed_tested:
+        best = max(speed_tested, key=lambda x: x['speed_mbps'])
+        logger.info(f"Speed tested: {len(speed_tested)} IPs, best {best['ip']} at {best['speed_mbps']} Mbit/s")
+    if cache is not None:
+        logger.info(f"Cache: {cache.summary()}")
+    logger.info(f"Stages: {metrics.progress()}")
+    if pipeline.stage_times:
+        logger.info("Stage finished at: " + ", ".join(f"{stage} {t:.2f}s" for stage, t in pipeline.stage_times.items()))
+    if pipeline.first_result_at is not None:
+        logger.info(f"Time to first result: {pipeline.first_result_at - pipeline.start_time:.2f} seconds")
     logger.info(f"Total time: {elapsed:.2f} seconds")
     
-    # 保存结果到CSV文件（按延迟排序）
+    # 保存结果到CSV文件（按延迟排序，包含续扫日志中已完成的结果）
     if sorted_results:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"working_ips_{timestamp}.csv"
-        
-        with open(filename, 'w', newline='', encoding='utf-8-sig') as f:
-            fieldnames = [
-                'ip', 'status', 'response_text', 'country', 'region', 'city', 'isp',
-                'ping_delay', 'proxy_available', 'proxy_port', 'colo_code', 'colo_chinese', 'response_time'
-            ]
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            
-            for row in sorted_results:
-                writer.writerow(row)
-        
-        logger.info(f"\nResults saved to {filename}")
+        write_results_csv(sorted_results)
+
+# 命令行参数，未指定时使用文件顶部的配置
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="测试 Cloudflare IP 的可用性、位置、机房和延迟")
+    parser.add_argument('--input', default='ip.txt', help='IP列表文件（支持单个IP、CIDR、IPv6）')
+    parser.add_argument('--mode', choices=['full', 'adaptive'], default=scan_mode, help='扫描模式')
+    parser.add_argument('--journal', default=journal_file, help='断点续扫日志文件')
+    parser.add_argument('--resume', action='store_true', help='从日志继续上次中断的扫描')
+    parser.add_argument('--concurrency', type=int, default=concurrency_limit, help='HTTP测试并发（自适应模式下为上限）')
+    parser.add_argument('--fixed-concurrency', action='store_true', help='关闭自适应并发，固定使用 --concurrency')
+    parser.add_argument('--workers', type=int, default=worker_processes, help='HTTP和延迟测试的进程数')
+    parser.add_argument('--uvloop', action='store_true', default=use_uvloop, help='子进程使用 uvloop')
+    parser.add_argument('--engine', choices=['aiohttp', 'raw'], default=probe_engine, help='HTTP测试引擎')
+    parser.add_argument('--samples', type=int, default=probe_samples, help='每个可用IP的HTTP请求次数（用于统计连接耗时百分位）')
+    parser.add_argument('--sort-by', default=sort_key,
+                        choices=['ping_delay'] + [f'{phase}_{p}' for phase in timing_phases for p in ('p50', 'p90')],
+                        help='结果排序字段')
+    parser.add_argument('--find', type=int, default=find_count, metavar='K', help='找到K个可用IP后提前结束')
+    parser.add_argument('--max-delay', type=float, default=find_max_delay, metavar='MS', help='--find 只计入延迟不超过该值的IP')
+    parser.add_argument('--geo-db', metavar='FILE', help='使用本地IP段数据库查询地理位置（CSV 或 .mmdb），不请求在线接口')
+    parser.add_argument('--no-proxy-check', action='store_true', help='跳过代理检查阶段（机房由HTTP测试获得）')
+    parser.add_argument('--speed-test', type=int, default=speed_test_top, metavar='N', help='对排名前N的IP下载测速')
+    parser.add_argument('--port', type=int, default=port, help='HTTPS端口')
+    parser.add_argument('--metrics-port', type=int, default=metrics_port, help='在该端口提供 Prometheus /metrics 接口')
+    parser.add_argument('--log-mode', choices=['full', 'sampled'], default=log_mode,
+                        help='sampled: 每秒最多输出 log_rate 条IP日志，定期输出进度汇总')
+    parser.add_argument('--daemon', metavar='HOST:PORT', help='常驻模式：持续复测并在该地址提供 /best 接口')
+    parser.add_argument('--query-history', action='store_true', help='查询历史库并排名，不进行扫描')
+    parser.add_argument('--since', default=history_window, help='查询的时间窗口，如 12h、7d')
+    parser.add_argument('--colo', help='只查询该机房的IP')
+    parser.add_argument('--country', help='只查询该国家的IP')
+    parser.add_argument('--min-probes', type=int, default=1, help='窗口内至少测试过的次数')
+    parser.add_argument('--top', type=int, default=20, help='输出的IP数，0 为全部')
+    parser.add_argument('--csv', metavar='FILE', help='把查询结果写入CSV文件')
+    parser.add_argument('--coordinator', metavar='HOST:PORT', help='作为分布式扫描的协调者监听该地址')
+    parser.add_argument('--expect-vantages', type=int, default=1, help='协调者等待的观测点数量')
+    parser.add_argument('--worker', metavar='URL', help='作为 worker 连接到协调者，如 http://127.0.0.1:8700')
+    parser.add_argument('--vantage', default=socket.gethostname(), help='worker 所在观测点的名称')
+    return parser.parse_args(argv)
+
+def apply_args(args):
+    global scan_mode, concurrency_limit, adaptive_concurrency, worker_processes, use_uvloop, probe_samples, sort_key, speed_test_top, port, metrics_port, log_mode, find_count, find_max_delay, proxy_check, geo_backend, geo_db_file, probe_engine
+    scan_mode = args.mode
+    concurrency_limit = args.concurrency
+    adaptive_concurrency = adaptive_concurrency and not args.fixed_concurrency
+    worker_processes = args.workers
+    use_uvloop = args.uvloop
+    probe_samples = args.samples
+    sort_key = args.sort_by
+    speed_test_top = args.speed_test
+    port = args.port
+    metrics_port = args.metrics_port
+    log_mode = args.log_mode
+    find_count = args.find
+    find_max_delay = args.max_delay
+    proxy_check = proxy_check and not args.no_proxy_check
+    probe_engine = args.engine
+    if args.geo_db:
+        geo_backend = 'offline'
+        geo_db_file = args.geo_db
 
 # 运行程序
 if __name__ == "__main__":
@@ -537,4 +2968,18 @@ if __name__ == "__main__":
     if platform.system() == 'Darwin':
         asyncio.get_event_loop().set_debug(False)
     
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    apply_args(args)
+    # 查询历史和分布式 worker 不做地理位置查询
+    if geo_backend == 'offline' and not (args.query_history or args.worker):
+        preload_offline_geo()
+    if args.query_history:
+        query_history(args)
+    elif args.daemon:
+        asyncio.run(run_daemon(args))
+    elif args.coordinator:
+        asyncio.run(run_coordinator(args))
+    elif args.worker:
+        asyncio.run(run_worker(args))
+    else:
+        asyncio.run(main(args))
\ No newline at end of file
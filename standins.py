@@ -0,0 +1,301 @@
+# 本地替身服务：在本机模拟 isdnsok.py 依赖的外部接口，便于测试和压测
+# 用法: python standins.py geo --port 8080 [--batch-limit 15 --window 60]
+#       python standins.py payload --port 8443 --cert c.pem --key k.pem [--rate 100]
+#       python standins.py suite [--hello-error-rate 0.9 --proxy-latency 200 --proxy-timeout-rate 0.01]
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import ssl
+import subprocess
+import time
+from aiohttp import web
+
+countries = ["美国", "日本", "新加坡", "德国", "中国香港"]
+cities = ["洛杉矶", "东京", "新加坡", "法兰克福", "香港"]
+colos = ["LAX", "NRT", "SIN", "FRA", "HKG"]
+
+# 按key得到稳定的 [0, 1) 值，key 为空时随机
+def roll(key=None):
+    if key is None:
+        return random.random()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], 'big') / 2**32
+
+# 响应延迟和故障分布：延迟（毫秒）按正态分布抽样；
+# timeout_rate 的请求挂起 hang 秒（超过客户端超时），error_rate 的请求返回错误
+class Faults:
+    def __init__(self, latency=0, jitter=0, error_rate=0, timeout_rate=0, hang=30):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+
+    # 等待抽样的延迟，返回 'error' 表示本次应返回错误；key 相同的请求结果相同
+    async def apply(self, key=None):
+        value = roll(key)
+        if value < self.timeout_rate:
+            await asyncio.sleep(self.hang)
+        delay = max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if value < self.timeout_rate + self.error_rate:
+            return 'error'
+        return None
+
+# 请求到达的本机地址，在 127.0.0.0/8 上扫描时即为被测IP
+def local_ip(request):
+    return request.transport.get_extra_info('sockname')[0]
+
+# 固定窗口计数器，与 ip-api.com 的限速方式一致
+class FixedWindow:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.started_at = time.monotonic()
+        self.used = 0
+
+    # 返回 (是否允许, 剩余次数, 窗口剩余秒数)
+    def hit(self):
+        now = time.monotonic()
+        if now - self.started_at >= self.window:
+            self.started_at = now
+            self.used = 0
+        ttl = max(int(self.window - (now - self.started_at)), 0)
+        if self.used >= self.limit:
+            return False, 0, ttl
+        self.used += 1
+        return True, self.limit - self.used, ttl
+
+# 根据IP生成稳定的假地理位置数据
+def fake_geo(ip):
+    index = hashlib.md5(ip.encode()).digest()[0] % len(countries)
+    return {
+        'status': 'success',
+        'country': countries[index],
+        'regionName': cities[index],
+        'city': cities[index],
+        'isp': 'Cloudflare, Inc.',
+        'org': 'Cloudflare',
+        'as': 'AS13335 Cloudflare, Inc.',
+        'query': ip,
+    }
+
+# hello world worker 替身：成功时返回 Hello World! 和带机房后缀的 CF-RAY 头（ray=False 时不带）
+# 失败的IP返回 403，同一IP每次结果相同；/cdn-cgi/trace 返回 colo= 行
+def make_hello_app(faults=None, ray=True):
+    faults = faults or Faults()
+    app = web.Application()
+
+    def colo_of(ip):
+        return colos[hashlib.md5(ip.encode()).digest()[0] % len(colos)]
+
+    async def hello(request):
+        ip = local_ip(request)
+        if await faults.apply(ip) == 'error':
+            return web.Response(status=403, text='Forbidden')
+        headers = {}
+        if ray:
+            headers['CF-RAY'] = f'{hashlib.md5(ip.encode()).hexdigest()[:16]}-{colo_of(ip)}'
+        return web.Response(text='Hello World!', headers=headers)
+
+    async def trace(request):
+        ip = local_ip(request)
+        return web.Response(text=f"fl=1\nh={request.host}\nip={request.remote}\ncolo={colo_of(ip)}\nhttp=http/1.1\n")
+
+    app.router.add_get('/', hello)
+    app.router.add_get('/cdn-cgi/trace', trace)
+    return app
+
+# 代理检查接口替身：GET /check?proxyip=IP，错误时返回非JSON的 500 响应
+def make_proxy_app(faults=None):
+    faults = faults or Faults()
+    app = web.Application()
+
+    async def check(request):
+        ip = request.query.get('proxyip', '').strip('[]')
+        start = time.monotonic()
+        if await faults.apply() == 'error':
+            return web.Response(status=500, text='Internal Server Error')
+        index = hashlib.md5(ip.encode()).digest()[0]
+        return web.json_response({
+            'success': index % 2 == 0,
+            'proxyIP': ip,
+            'portRemote': 443,
+            'colo': colos[index % len(colos)],
+            'responseTime': round((time.monotonic() - start) * 1000),
+        })
+
+    app.router.add_get('/check', check)
+    return app
+
+# 地理位置接口替身：GET /json/{ip} 与 POST /batch，分别限速
+def make_geo_app(single_limit=45, batch_limit=15, window=60, max_batch=100, faults=None):
+    faults = faults or Faults()
+    single_window = FixedWindow(single_limit, window)
+    batch_window = FixedWindow(batch_limit, window)
+    app = web.Application()
+    app['stats'] = {'requests': 0, 'rate_limited': 0}
+
+    def limited(counter):
+        allowed, remaining, ttl = counter.hit()
+        headers = {'X-Rl': str(remaining), 'X-Ttl': str(ttl)}
+        app['stats']['requests'] += 1
+        if not allowed:
+            app['stats']['rate_limited'] += 1
+        return allowed, headers
+
+    async def single(request):
+        allowed, headers = limited(single_window)
+        if not allowed:
+            return web.Response(status=429, text='Too Many Requests', headers=headers)
+        if await faults.apply() == 'error':
+            return web.Response(status=500, text='Internal Server Error', headers=headers)
+        return web.json_response(fake_geo(request.match_info['ip']), headers=headers)
+
+    async def batch(request):
+        allowed, headers = limited(batch_window)
+        if not allowed:
+            return web.Response(status=429, text='Too Many Requests', headers=headers)
+        if await faults.apply() == 'error':
+            return web.Response(status=500, text='Internal Server Error', headers=headers)
+        ips = await request.json()
+        if not isinstance(ips, list) or len(ips) > max_batch:
+            return web.json_response({'message': 'invalid batch'}, status=422, headers=headers)
+        return web.json_response([fake_geo(ip) for ip in ips], headers=headers)
+
+    app.router.add_get('/json/{ip}', single)
+    app.router.add_post('/batch', batch)
+    return app
+
+# 测速下载替身：GET /__down?bytes=N 分块返回N字节，可按 rate（Mbit/s）限速
+def make_payload_app(rate=0, chunk_size=64 * 1024):
+    chunk = b'0' * chunk_size
+    app = web.Application()
+
+    async def down(request):
+        size = int(request.query.get('bytes', 0))
+        response = web.StreamResponse(headers={'Content-Type': 'application/octet-stream'})
+        response.content_length = size
+        await response.prepare(request)
+        start = time.monotonic()
+        sent = 0
+        while sent < size:
+            data = chunk[:min(chunk_size, size - sent)]
+            await response.write(data)
+            sent += len(data)
+            if rate:
+                # 超出目标速率时等待，使平均速率不超过 rate
+                ahead = sent * 8 / (rate * 1e6) - (time.monotonic() - start)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+        await response.write_eof()
+        return response
+
+    app.router.add_get('/__down', down)
+    return app
+
+# 用 openssl 命令生成自签名证书，返回 (证书, 私钥) 路径
+def self_signed_cert(directory):
+    cert = os.path.join(directory, 'standin_cert.pem')
+    key = os.path.join(directory, 'standin_key.pem')
+    if not (os.path.exists(cert) and os.path.exists(key)):
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30',
+             '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+            check=True, capture_output=True,
+        )
+    return cert, key
+
+def server_ssl_context(cert, key):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+# 在同一个事件循环中启动多个服务，sites 为 (app, host, port, ssl_context) 列表
+async def serve(sites):
+    runners = []
+    for app, host, port, context in sites:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port, ssl_context=context).start()
+        runners.append(runner)
+    print(f"Stand-ins listening on ports {', '.join(str(site[2]) for site in sites)}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+def add_fault_args(parser, prefix, latency=0):
+    parser.add_argument(f'--{prefix}-latency', type=float, default=latency, help='平均响应延迟（毫秒）')
+    parser.add_argument(f'--{prefix}-jitter', type=float, default=0, help='延迟标准差（毫秒）')
+    parser.add_argument(f'--{prefix}-error-rate', type=float, default=0, help='返回错误的比例')
+    parser.add_argument(f'--{prefix}-timeout-rate', type=float, default=0, help='挂起直到客户端超时的比例')
+
+def faults_from_args(args, prefix):
+    prefix = prefix.replace('-', '_')
+    return Faults(
+        getattr(args, f'{prefix}_latency'),
+        getattr(args, f'{prefix}_jitter'),
+        getattr(args, f'{prefix}_error_rate'),
+        getattr(args, f'{prefix}_timeout_rate'),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="isdnsok.py 的本地替身服务")
+    sub = parser.add_subparsers(dest='service', required=True)
+
+    geo = sub.add_parser('geo', help='ip-api.com 替身')
+    geo.add_argument('--host', default='127.0.0.1')
+    geo.add_argument('--port', type=int, default=8080)
+    geo.add_argument('--single-limit', type=int, default=45, help='单IP接口每个窗口的请求数')
+    geo.add_argument('--batch-limit', type=int, default=15, help='批量接口每个窗口的请求数')
+    geo.add_argument('--window', type=int, default=60, help='限速窗口（秒）')
+
+    payload = sub.add_parser('payload', help='测速下载替身（HTTPS）')
+    payload.add_argument('--host', default='127.0.0.1')
+    payload.add_argument('--port', type=int, default=8443)
+    payload.add_argument('--rate', type=float, default=0, help='限速（Mbit/s），0 为不限')
+    payload.add_argument('--cert', required=True, help='证书文件')
+    payload.add_argument('--key', required=True, help='私钥文件')
+
+    # 压测用的整套替身：hello world worker（HTTPS）、地理位置接口、代理检查接口
+    # hello 监听 0.0.0.0，这样 127.0.0.0/8 上的任意地址都能连上
+    suite = sub.add_parser('suite', help='hello + geo + proxy 整套替身')
+    suite.add_argument('--hello-port', type=int, default=8443)
+    suite.add_argument('--geo-port', type=int, default=8081)
+    suite.add_argument('--proxy-port', type=int, default=8082)
+    suite.add_argument('--cert', help='证书文件（不指定时生成自签名证书）')
+    suite.add_argument('--key', help='私钥文件')
+    suite.add_argument('--cert-dir', default='.', help='自签名证书存放目录')
+    suite.add_argument('--single-limit', type=int, default=45)
+    suite.add_argument('--batch-limit', type=int, default=15)
+    suite.add_argument('--window', type=int, default=60)
+    suite.add_argument('--seed', type=int, help='随机种子')
+    suite.add_argument('--hello-no-ray', action='store_true', help='hello 响应不带 CF-RAY 头')
+    add_fault_args(suite, 'hello')
+    add_fault_args(suite, 'geo')
+    add_fault_args(suite, 'proxy', latency=100)
+
+    args = parser.parse_args()
+    if args.service == 'suite':
+        if args.seed is not None:
+            random.seed(args.seed)
+        cert, key = (args.cert, args.key) if args.cert else self_signed_cert(args.cert_dir)
+        geo_app = make_geo_app(args.single_limit, args.batch_limit, args.window, faults=faults_from_args(args, 'geo'))
+        asyncio.run(serve([
+            (make_hello_app(faults_from_args(args, 'hello'), ray=not args.hello_no_ray), '0.0.0.0', args.hello_port, server_ssl_context(cert, key)),
+            (geo_app, '127.0.0.1', args.geo_port, None),
+            (make_proxy_app(faults_from_args(args, 'proxy')), '127.0.0.1', args.proxy_port, None),
+        ]))
+    elif args.service == 'geo':
+        app = make_geo_app(args.single_limit, args.batch_limit, args.window)
+        web.run_app(app, host=args.host, port=args.port)
+    elif args.service == 'payload':
+        web.run_app(make_payload_app(args.rate), host=args.host, port=args.port,
+                    ssl_context=server_ssl_context(args.cert, args.key))
+
+if __name__ == "__main__":
+    main()